@@ -3,6 +3,20 @@
 #include <iostream>
 #include <fstream>
 #include <string>
+#include <sstream>
+#include <set>
+#include <map>
+#include <bitset>
+#include <numeric>
+#include <limits>
+#include <functional>
+#include <stdexcept>
+
+#include <ROOT/RVec.hxx>
+#include <Math/Vector4D.h>
+#include <Math/VectorUtil.h>
+
+#include "MatchingTools.h"
 
 using LorentzVectorXYZ = ROOT::Math::LorentzVector<ROOT::Math::PxPyPzE4D<double>>;
 using LorentzVectorM = ROOT::Math::LorentzVector<ROOT::Math::PtEtaPhiM4D<double>>;
@@ -14,7 +28,6 @@ using RVecF = ROOT::VecOps::RVec<float>;
 using RVecB = ROOT::VecOps::RVec<bool>;
 using RVecVecI = ROOT::VecOps::RVec<RVecI>;
 using RVecLV = ROOT::VecOps::RVec<LorentzVectorM>;
-using RVecSetInt = ROOT::VecOps::RVec<std::set<int>>;
 
 enum class Leg : int {
   e = 1,
@@ -142,18 +155,123 @@ RVecLV GetP4(const RVecF& pt, const RVecF& eta, const RVecF& phi, const RVecF& m
   return p4;
 }
 
-RVecB RemoveOverlaps(const RVecLV& obj_p4, const RVecB& pre_sel, const std::vector<RVecLV>& other_objects,
+// Structure-of-arrays collection of four-momenta in the (pt, eta, phi, m) representation with float precision.
+// Cartesian components are computed on request.
+struct LVCollection {
+  RVecF pt, eta, phi, mass;
+
+  LVCollection() {}
+  LVCollection(const RVecF& pt_, const RVecF& eta_, const RVecF& phi_, const RVecF& mass_)
+    : pt(pt_), eta(eta_), phi(phi_), mass(mass_)
+  {
+    if(eta.size() != pt.size() || phi.size() != pt.size() || mass.size() != pt.size())
+      throw std::runtime_error("LVCollection: inconsistent sizes of the momentum components.");
+  }
+  explicit LVCollection(const RVecLV& p4)
+  {
+    reserve(p4.size());
+    for(const auto& v : p4)
+      push_back(v);
+  }
+
+  size_t size() const { return pt.size(); }
+  bool empty() const { return pt.empty(); }
+  void reserve(size_t n) { pt.reserve(n); eta.reserve(n); phi.reserve(n); mass.reserve(n); }
+  void push_back(const LorentzVectorM& p4)
+  {
+    pt.push_back(p4.pt());
+    eta.push_back(p4.eta());
+    phi.push_back(p4.phi());
+    mass.push_back(p4.mass());
+  }
+
+  LorentzVectorM at(size_t i) const { return LorentzVectorM(pt.at(i), eta.at(i), phi.at(i), mass.at(i)); }
+  LorentzVectorM operator[](size_t i) const { return LorentzVectorM(pt[i], eta[i], phi[i], mass[i]); }
+  RVecLV ToRVecLV() const
+  {
+    RVecLV p4;
+    p4.reserve(size());
+    for(size_t i = 0; i < size(); ++i)
+      p4.push_back((*this)[i]);
+    return p4;
+  }
+
+  float px(size_t i) const { return pt[i] * std::cos(phi[i]); }
+  float py(size_t i) const { return pt[i] * std::sin(phi[i]); }
+  float pz(size_t i) const { return pt[i] * std::sinh(eta[i]); }
+  float p(size_t i) const { return pt[i] * std::cosh(eta[i]); }
+  float E(size_t i) const { return std::hypot(p(i), mass[i]); }
+};
+
+LVCollection GetP4Collection(const RVecF& pt, const RVecF& eta, const RVecF& phi, const RVecF& mass,
+                             const RVecS& indices)
+{
+  LVCollection p4;
+  p4.reserve(indices.size());
+  for(auto idx : indices) {
+    p4.pt.push_back(pt[idx]);
+    p4.eta.push_back(eta[idx]);
+    p4.phi.push_back(phi[idx]);
+    p4.mass.push_back(mass[idx]);
+  }
+  return p4;
+}
+
+namespace matching {
+  // Storage for the eta/phi arrays of the collections that do not keep them contiguous.
+  struct EtaPhiBuffer {
+    std::vector<float> eta, phi;
+  };
+
+  inline EtaPhiView MakeEtaPhiView(const LVCollection& p4, EtaPhiBuffer&)
+  {
+    return EtaPhiView{p4.eta.data(), p4.phi.data(), p4.size()};
+  }
+
+  inline EtaPhiView MakeEtaPhiView(const RVecLV& p4, EtaPhiBuffer& buffer)
+  {
+    buffer.eta.resize(p4.size());
+    buffer.phi.resize(p4.size());
+    for(size_t i = 0; i < p4.size(); ++i) {
+      buffer.eta[i] = p4[i].eta();
+      buffer.phi[i] = p4[i].phi();
+    }
+    return EtaPhiView{buffer.eta.data(), buffer.phi.data(), p4.size()};
+  }
+
+  inline EtaPhiView MakeEtaPhiView(const LorentzVectorM& p4, EtaPhiBuffer& buffer)
+  {
+    buffer.eta.assign(1, p4.eta());
+    buffer.phi.assign(1, p4.phi());
+    return EtaPhiView{buffer.eta.data(), buffer.phi.data(), 1};
+  }
+
+  template<typename Collection1, typename Collection2>
+  DeltaR2Matrix ComputeDeltaR2(const Collection1& coll1, const Collection2& coll2, float max_deltaR,
+                               const RVecB* sel1 = nullptr, const RVecB* sel2 = nullptr)
+  {
+    EtaPhiBuffer buffer1, buffer2;
+    return ComputeDeltaR2(MakeEtaPhiView(coll1, buffer1), MakeEtaPhiView(coll2, buffer2), max_deltaR, sel1, sel2);
+  }
+}
+
+template<typename Collection, typename OtherCollection = RVecLV>
+RVecB RemoveOverlaps(const Collection& obj_p4, const RVecB& pre_sel, const std::vector<OtherCollection>& other_objects,
                      size_t min_number_of_non_overlaps, double min_deltaR)
 {
   RVecB result(pre_sel);
-  const double min_deltaR2 = std::pow(min_deltaR, 2);
+  const float min_deltaR2 = std::pow(min_deltaR, 2);
+
+  std::vector<matching::DeltaR2Matrix> dR2(other_objects.size());
+  for(size_t col_idx = 0; col_idx < other_objects.size(); ++col_idx)
+    dR2[col_idx] = matching::ComputeDeltaR2(obj_p4, other_objects[col_idx], min_deltaR, &pre_sel);
 
-  const auto hasMinNumberOfNonOverlaps = [&](const LorentzVectorM& p4) {
+  const auto hasMinNumberOfNonOverlaps = [&](size_t obj_idx) {
     size_t cnt = 0;
-    for(const auto& other_obj_col : other_objects) {
-      for(const auto& other_obj_p4 : other_obj_col) {
-        const double dR2 = ROOT::Math::VectorUtil::DeltaR2(p4, other_obj_p4);
-        if(dR2 > min_deltaR2) {
+    for(const auto& other_dR2 : dR2) {
+      const float* row = other_dR2.Row(obj_idx);
+      for(size_t other_idx = 0; other_idx < other_dR2.n_cols; ++other_idx) {
+        if(row[other_idx] > min_deltaR2) {
           ++cnt;
           if(cnt >= min_number_of_non_overlaps)
             return true;
@@ -164,51 +282,28 @@ RVecB RemoveOverlaps(const RVecLV& obj_p4, const RVecB& pre_sel, const std::vect
   };
 
   for(size_t obj_idx = 0; obj_idx < obj_p4.size(); ++obj_idx) {
-    result[obj_idx] = pre_sel[obj_idx] && hasMinNumberOfNonOverlaps(obj_p4.at(obj_idx));
+    result[obj_idx] = pre_sel[obj_idx] && hasMinNumberOfNonOverlaps(obj_idx);
   }
   return result;
 }
 
-int FindMatching(const LorentzVectorM& target_p4, const RVecLV& ref_p4,const float deltaR_thr){
-  double deltaR_min = deltaR_thr;
-  int current_idx = -1;
-  for(int refIdx =0; refIdx<ref_p4.size(); refIdx++){
-    auto dR_targetRef= ROOT::Math::VectorUtil::DeltaR(target_p4, ref_p4.at(refIdx));
-    if ( dR_targetRef < deltaR_min ) {
-      deltaR_min = dR_targetRef ;
-      current_idx = refIdx;
-    }
-  }
-  return current_idx;
+template<typename Collection>
+int FindMatching(const LorentzVectorM& target_p4, const Collection& ref_p4,const float deltaR_thr){
+  const auto dR2 = matching::ComputeDeltaR2(target_p4, ref_p4, deltaR_thr);
+  return dR2.BestInRow(0, std::pow(deltaR_thr, 2));
 }
 
-RVecI FindMatching(const RVecLV& target_p4, const RVecLV& ref_p4,const float deltaR_thr){
+template<typename TargetCollection, typename RefCollection>
+RVecI FindMatching(const TargetCollection& target_p4, const RefCollection& ref_p4,const float deltaR_thr){
   RVecI targetIndices(target_p4.size(), -1);
+  const auto dR2 = matching::ComputeDeltaR2(target_p4, ref_p4, deltaR_thr);
+  const float deltaR2_thr = std::pow(deltaR_thr, 2);
   for(int targetIdx =0; targetIdx<target_p4.size(); targetIdx++){
-    int refIdxFound = FindMatching(target_p4[targetIdx], ref_p4, deltaR_thr);
-    targetIndices[targetIdx] = refIdxFound;
+    targetIndices[targetIdx] = dR2.BestInRow(targetIdx, deltaR2_thr);
   }
   return targetIndices;
 }
 
-RVecSetInt FindMatchingSet(const RVecB& pre_sel_target, const RVecB& pre_sel_ref, const RVecLV& target_p4,
-    const RVecLV& ref_p4, const float dR_thr)
-    {
-        RVecSetInt findMatching(pre_sel_target.size());
-        for(size_t ref_idx = 0 ; ref_idx < pre_sel_ref.size() ; ref_idx ++ ){
-            if(pre_sel_ref[ref_idx]==0) continue;
-            for(size_t target_idx = 0 ; target_idx < pre_sel_target.size() ; target_idx ++ ){
-                if(pre_sel_target[target_idx]==0) continue;
-                auto dR_current = ROOT::Math::VectorUtil::DeltaR(target_p4[target_idx], ref_p4[ref_idx]);
-                if(dR_current < dR_thr ){
-                    findMatching[target_idx].insert(ref_idx);
-                }
-            }
-        }
-        return findMatching;
-    }
-
-
 namespace v_ops{
   template<typename LV>
   RVecF pt(const LV& p4){
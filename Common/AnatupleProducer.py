@@ -1,9 +1,13 @@
 import ROOT
 import numpy as np
+import os
 import Common.BaselineSelection as Baseline
 import Common.Utilities as Utilities
 import Common.ReportTools as ReportTools
+import Common.ProfilingTools as ProfilingTools
+import Common.EventIndex as EventIndex
 import Common.triggerSel as Triggers
+import Common.CompileTools as CompileTools
 import Corrections.Corrections as Corrections
 
 deepTauScores= ["rawDeepTau2017v2p1VSe","rawDeepTau2017v2p1VSmu",
@@ -28,23 +32,34 @@ def DefineAndAppend(df, varToDefine, varToCall):
     colToSave.append(varToDefine)
     return df
 
-def addAllVariables(df, syst_name, isData, trigger_class):
+def addAllVariables(df, syst_name, isData, trigger_class, profiler=None, suffix=''):
+    if profiler is None:
+        profiler = ProfilingTools.StageProfiler(enabled=False)
+    df = profiler.Mark(df, "RecoLeptonsSelection", suffix)
     df = Baseline.SelectRecoP4(df, syst_name)
     df = Baseline.RecoLeptonsSelection(df)
+    df = profiler.Mark(df, "RecoJetAcceptance", suffix)
     df = Baseline.RecoJetAcceptance(df)
+    df = profiler.Mark(df, "RecoHttCandidateSelection", suffix)
     df = Baseline.RecoHttCandidateSelection(df)
+    df = profiler.Mark(df, "RecoJetSelection", suffix)
     df = Baseline.RecoJetSelection(df)
     df = Baseline.RequestOnlyResolvedRecoJets(df)
     df = Baseline.ThirdLeptonVeto(df)
+    df = profiler.Mark(df, "DefineHbbCand", suffix)
     df = Baseline.DefineHbbCand(df)
+    # HbbCandidate is only defined, so it is evaluated here to be accounted to its own stage
+    df = profiler.Mark(df, "TriggerMatching", suffix, columns=[ "HbbCandidate" ])
     if trigger_class is not None:
         df,hltBranches = trigger_class.ApplyTriggers(df, isData)
         colToSave.extend(hltBranches)
+    # includes the evaluation of the output variables
+    df = profiler.Mark(df, "SnapshotWrite", suffix)
     df = DefineAndAppend(df, f"Tau_recoJetMatchIdx", f"FindMatching(Tau_p4, Jet_p4, 0.5)")
     df = DefineAndAppend(df, f"Muon_recoJetMatchIdx", f"FindMatching(Muon_p4, Jet_p4, 0.5)")
     df = DefineAndAppend(df, f"Electron_recoJetMatchIdx", f"FindMatching(Electron_p4, Jet_p4, 0.5)")
     df = DefineAndAppend(df,"channelId","static_cast<int>(httCand.channel())")
-    jet_obs = JetObservables
+    jet_obs = list(JetObservables)
     if not isData:
         jet_obs.extend(JetObservablesMC)
         colToSave.append("LHE_HT")
@@ -103,18 +118,53 @@ def addAllVariables(df, syst_name, isData, trigger_class):
     return df
 
 
+def CopyTree(inFileName, outFileName, treeName):
+    inputRootFile = ROOT.TFile.Open(inFileName, "READ")
+    tree = inputRootFile.Get(treeName)
+    outputRootFile = ROOT.TFile(outFileName, "UPDATE")
+    outputRootFile.cd()
+    tree_copy = tree.CloneTree(-1, "fast")
+    tree_copy.Write(treeName, ROOT.TObject.kOverwrite)
+    outputRootFile.Close()
+    inputRootFile.Close()
+
 def createAnatuple(inFile, outFile, period, sample, X_mass, snapshotOptions,range, isData, evtIds, isHH, triggerFile,
-                   store_noncentral):
+                   store_noncentral, single_loop=False, profile=False, eventIndex=None):
     Baseline.Initialize(True, True)
     if not isData:
         Corrections.Initialize(period=period)
 
-    trigger_class = Triggers.Triggers(triggerFile) if triggerFile is not None else None
-    df = ROOT.RDataFrame("Events", inFile)
+    expression_cache = CompileTools.GetExpressionCache() if CompileTools.UseExpressionCache() else None
+    trigger_class = Triggers.Triggers(triggerFile, expression_cache=expression_cache) if triggerFile is not None else None
+    profiler = ProfilingTools.StageProfiler(enabled=profile)
+    input_entries = None
+    if eventIndex is not None and len(evtIds) > 0:
+        # only the entries of the requested events are read
+        index = EventIndex.EventIndex.Load(eventIndex)
+        eventIds = EventIndex.ParseEventIds(evtIds)
+        df, df_inputs = index.MakeDataFrame(eventIds, file=inFile)
+        input_entries = index.Lookup(eventIds, file=inFile)
+    else:
+        df = ROOT.RDataFrame("Events", inFile)
+    df = profiler.Mark(df, "Input", starts_event=True)
+    df_input = df
     if range is not None:
+        if ROOT.IsImplicitMTEnabled():
+            raise RuntimeError("Range is not supported in the multi-threaded mode.")
         df = df.Range(range)
-    if len(evtIds) > 0:
+    if len(evtIds) > 0 and eventIndex is None:
         df = df.Filter(f"static const std::set<ULong64_t> evts = {{ {evtIds} }}; return evts.count(event) > 0;")
+    # event order in the output is not preserved in the multi-threaded mode, so rdfentry_ is stored to allow
+    # a reproducible ordering. It is not guaranteed to be the entry number in the input tree.
+    # With the event index, rdfentry_ is the position in the entry list, so the input entry is stored instead.
+    if input_entries is None:
+        df = DefineAndAppend(df,"rdfEntry", "static_cast<ULong64_t>(rdfentry_)")
+    else:
+        entry_map = ', '.join(f'{{ {{ {run}u, {lumi}u, {event}ull }}, {entry}ull }}'
+                              for run, lumi, event, _, entry in input_entries)
+        df = DefineAndAppend(df,"rdfEntry", f"""
+            static const std::map<std::tuple<UInt_t, UInt_t, ULong64_t>, ULong64_t> entries = {{ {entry_map} }};
+            return entries.at(std::make_tuple(run, luminosityBlock, event));""")
     df = DefineAndAppend(df,"sample_type", f"static_cast<int>(SampleType::{sample})")
     df = DefineAndAppend(df,"period", f"static_cast<int>(Period::{period})")
     df = DefineAndAppend(df,"X_mass", f"static_cast<int>({X_mass})")
@@ -128,17 +178,43 @@ def createAnatuple(inFile, outFile, period, sample, X_mass, snapshotOptions,rang
     else:
         df, syst_dict = Corrections.applyScaleUncertainties(df)
 
+    snapshots = []
+    reports = ReportTools.DeferredReport()
+    tmp_files = {}
     for syst_name, source_name in syst_dict.items():
         suffix = '' if syst_name in [ 'Central', 'nano' ] else f'_{syst_name}'
         if len(suffix) and not store_noncentral: continue
-        df_syst = addAllVariables(df, syst_name, isData, trigger_class)
-        report = df_syst.Report()
-        histReport = ReportTools.SaveReport(report.GetValue(), reoprtName=f"Report{suffix}")
-        varToSave = Utilities.ListToVector(colToSave)
-        df_syst.Snapshot(f"Events{suffix}", outFile, varToSave, snapshotOptions)
-        outputRootFile= ROOT.TFile(outFile, "UPDATE")
-        outputRootFile.WriteTObject(histReport, f"Report{suffix}", "Overwrite")
-        outputRootFile.Close()
+        df_syst = addAllVariables(df, syst_name, isData, trigger_class, profiler, suffix)
+        reports.Book(df_syst, f"Report{suffix}")
+        varToSave = Utilities.ListToVector(list(dict.fromkeys(colToSave)))
+        if single_loop:
+            # lazy snapshots can't share the output file, so ES variations are written to temporary files
+            # and moved to the output file after the event loop
+            syst_outFile = outFile
+            if len(suffix):
+                syst_outFile = os.path.splitext(outFile)[0] + f'{suffix}.tmp.root'
+                tmp_files[suffix] = syst_outFile
+            syst_snapshotOptions = ROOT.RDF.RSnapshotOptions(snapshotOptions)
+            syst_snapshotOptions.fLazy = True
+            if len(suffix):
+                syst_snapshotOptions.fMode = "RECREATE"
+            snapshots.append(df_syst.Snapshot(f"Events{suffix}", syst_outFile, varToSave, syst_snapshotOptions))
+        else:
+            syst_snapshotOptions = ROOT.RDF.RSnapshotOptions(snapshotOptions)
+            syst_snapshotOptions.fLazy = True
+            snapshot = df_syst.Snapshot(f"Events{suffix}", outFile, varToSave, syst_snapshotOptions)
+            profiler_end = profiler.EndEvent(df_input)
+            snapshot.GetValue()
+
+    if single_loop:
+        profiler_end = profiler.EndEvent(df_input)
+        ROOT.RDF.RunGraphs(snapshots)
+        for suffix, tmp_file in tmp_files.items():
+            CopyTree(tmp_file, outFile, f"Events{suffix}")
+            os.remove(tmp_file)
+    # reports are filled by the same event loop(s) as the snapshots
+    reports.Write(outFile)
+    profiler.Write(outFile, printOut=True)
 
 if __name__ == "__main__":
     import argparse
@@ -154,11 +230,21 @@ if __name__ == "__main__":
     parser.add_argument('--compressionAlgo', type=str, default="LZMA")
     parser.add_argument('--nEvents', type=int, default=None)
     parser.add_argument('--evtIds', type=str, default='')
+    parser.add_argument('--eventIndex', type=str, default=None,
+                        help="event index of the input (see Common/EventIndex.py) used to read only the entries"
+                             " of --evtIds, which can also be given as run:lumi:event")
     parser.add_argument('--store-noncentral', action="store_true", help="Store ES variations.")
     parser.add_argument('--triggerFile', type=str, default=None)
+    parser.add_argument('--nThreads', type=int, default=1)
+    parser.add_argument('--single-loop', action="store_true",
+                        help="Produce central and ES variations in a single event loop.")
+    parser.add_argument('--profile', action="store_true",
+                        help="Measure the time, event rate and bytes read per selection stage.")
 
     args = parser.parse_args()
 
+    if args.nThreads > 1:
+        ROOT.EnableImplicitMT(args.nThreads)
     ROOT.gROOT.ProcessLine(".include "+ os.environ['ANALYSIS_PATH'])
     ROOT.gROOT.ProcessLine('#include "Common/GenTools.h"')
     isHH=False
@@ -177,4 +263,5 @@ if __name__ == "__main__":
     snapshotOptions.fCompressionAlgorithm = getattr(ROOT.ROOT, 'k' + args.compressionAlgo)
     snapshotOptions.fCompressionLevel = args.compressionLevel
     createAnatuple(args.inFile, args.outFile, args.period, args.sample_type, args.mass, snapshotOptions, args.nEvents,
-                   isData, args.evtIds, isHH, args.triggerFile, args.store_noncentral)
+                   isData, args.evtIds, isHH, args.triggerFile, args.store_noncentral, args.single_loop,
+                   args.profile, args.eventIndex)
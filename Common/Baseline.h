@@ -0,0 +1,7 @@
+/*! Headers required by the baseline selection. They are compiled into a single library by
+    CompileTools.LoadHeader, so that the selection code is not parsed by the interpreter in every job. */
+
+#pragma once
+
+#include "BaselineGenSelection.h"
+#include "BaselineRecoSelection.h"
@@ -6,9 +6,8 @@
 #include "HHCore.h"
 
 std::shared_ptr<HTTCand> GetGenHTTCandidate(int evt, const RVecI& GenPart_pdgId,
-                                            const RVecVecI& GenPart_daughters, const RVecI& GenPart_statusFlags,
-                                            const RVecF& GenPart_pt, const RVecF& GenPart_eta,
-                                            const RVecF& GenPart_phi, const RVecF& GenPart_mass,
+                                            const GenPartDaughters& GenPart_daughters, const RVecI& GenPart_statusFlags,
+                                            const RVecF& GenPart_pt, const RVecLV& GenPart_visibleP4,
                                             bool throw_error_if_not_found)
 {
   try {
@@ -71,8 +70,7 @@ std::shared_ptr<HTTCand> GetGenHTTCandidate(int evt, const RVecI& GenPart_pdgId,
         const auto& genPart_info = ParticleDB::GetParticleInfo(genPart_pdg);
         htt_cand.leg_type[leg_idx] = PdGToLeg(genPart_pdg);
         htt_cand.leg_charge[leg_idx] = genPart_info.charge;
-        htt_cand.leg_p4[leg_idx] = GetVisibleP4(genPart_index, GenPart_pdgId, GenPart_daughters,
-                                                GenPart_pt, GenPart_eta, GenPart_phi, GenPart_mass);
+        htt_cand.leg_p4[leg_idx] = GenPart_visibleP4.at(genPart_index);
     }
 
     return std::make_shared<HTTCand>(htt_cand);
@@ -84,7 +82,7 @@ std::shared_ptr<HTTCand> GetGenHTTCandidate(int evt, const RVecI& GenPart_pdgId,
 }
 
 int GetGenHBBIndex(int evt, const RVecI& GenPart_pdgId,
-                           const RVecVecI& GenPart_daughters, const RVecI& GenPart_statusFlags)
+                           const GenPartDaughters& GenPart_daughters, const RVecI& GenPart_statusFlags)
 {
   try {
     std::set<int> hbb_indices;
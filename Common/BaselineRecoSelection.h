@@ -1,4 +1,6 @@
 #pragma once
+#include <array>
+#include <algorithm>
 #include "AnalysisTools.h"
 #include "HHCore.h"
 
@@ -88,16 +90,17 @@ RVecI GenRecoJetMatching(int event,const RVecI& Jet_idx, const RVecI& GenJet_idx
 {
   RVecI recoJetMatched (Jet_idx.size(), -1);
   std::set<size_t> taken_jets;
+  const auto dR2 = matching::ComputeDeltaR2(GenJet_p4, Jet_p4, DeltaR_thr, &GenJet_sel, &Jet_sel);
   for(size_t gen_idx = 0; gen_idx < GenJet_p4.size(); ++gen_idx) {
     if(GenJet_sel[gen_idx]!=1) continue;
     size_t best_jet_idx = Jet_p4.size();
-    float deltaR_min = std::numeric_limits<float>::infinity();
+    float deltaR2_min = std::pow(DeltaR_thr, 2);
+    const float* row = dR2.Row(gen_idx);
     for(size_t reco_idx = 0; reco_idx < Jet_p4.size(); ++reco_idx) {
-      if(Jet_sel[reco_idx]!=1 || taken_jets.count(reco_idx)) continue;
-      auto deltaR = ROOT::Math::VectorUtil::DeltaR(Jet_p4[reco_idx], GenJet_p4[gen_idx]);
-      if(deltaR<deltaR_min && deltaR<DeltaR_thr){
+      if(taken_jets.count(reco_idx)) continue;
+      if(row[reco_idx]<deltaR2_min){
         best_jet_idx = reco_idx;
-        deltaR_min=deltaR;
+        deltaR2_min=row[reco_idx];
       }
     }
     if(best_jet_idx<Jet_p4.size()) {
@@ -128,34 +131,114 @@ HbbCand GetHbbCandidate(const RVecF& HHbTagScores, const RVecB& JetSel,  const R
 }
 
 
+// Set of trigger objects represented as a bitmask over the TrigObj indices.
+// The first 256 bits are stored inline, the words for larger indices are allocated only when needed.
+struct TrigObjMask {
+  static constexpr size_t NInlineWords = 4;
+
+  std::array<uint64_t, NInlineWords> words{};
+  std::vector<uint64_t> extra_words;
+
+  size_t NWords() const { return NInlineWords + extra_words.size(); }
+  uint64_t Word(size_t n) const
+  {
+    if(n < NInlineWords) return words[n];
+    return n < NWords() ? extra_words[n - NInlineWords] : 0;
+  }
+  uint64_t& Word(size_t n)
+  {
+    if(n < NInlineWords) return words[n];
+    if(n >= NWords())
+      extra_words.resize(n + 1 - NInlineWords, 0);
+    return extra_words[n - NInlineWords];
+  }
+
+  void Set(size_t idx) { Word(idx / 64) |= uint64_t(1) << (idx % 64); }
+  void Reset(size_t idx)
+  {
+    if(idx / 64 < NWords())
+      Word(idx / 64) &= ~(uint64_t(1) << (idx % 64));
+  }
+  bool Test(size_t idx) const { return (Word(idx / 64) >> (idx % 64)) & 1; }
+  bool Any() const
+  {
+    for(size_t n = 0; n < NWords(); ++n)
+      if(Word(n)) return true;
+    return false;
+  }
+  TrigObjMask AndNot(const TrigObjMask& other) const
+  {
+    TrigObjMask result;
+    result.extra_words.resize(extra_words.size());
+    for(size_t n = 0; n < NWords(); ++n)
+      result.Word(n) = Word(n) & ~other.Word(n);
+    return result;
+  }
+  // Index of the lowest set bit, or -1 if the mask is empty.
+  int First() const
+  {
+    for(size_t n = 0; n < NWords(); ++n)
+      if(Word(n)) return static_cast<int>(n * 64 + __builtin_ctzll(Word(n)));
+    return -1;
+  }
+};
+
+using RVecTrigObjMask = ROOT::VecOps::RVec<TrigObjMask>;
+
+// For each offline object, the mask of the trigger objects that are within dR_thr.
+template<typename TargetCollection, typename RefCollection>
+RVecTrigObjMask FindMatchingMask(const RVecB& pre_sel_target, const RVecB& pre_sel_ref, const TargetCollection& target_p4,
+                                 const RefCollection& ref_p4, float dR_thr)
+{
+  RVecTrigObjMask result(pre_sel_target.size());
+  const auto dR2 = matching::ComputeDeltaR2(target_p4, ref_p4, dR_thr, &pre_sel_target, &pre_sel_ref);
+  const float dR2_thr = std::pow(dR_thr, 2);
+  for(size_t target_idx = 0; target_idx < dR2.n_rows; ++target_idx) {
+    const float* row = dR2.Row(target_idx);
+    for(size_t ref_idx = 0; ref_idx < dR2.n_cols; ++ref_idx) {
+      if(row[ref_idx] < dR2_thr)
+        result[target_idx].Set(ref_idx);
+    }
+  }
+  return result;
+}
+
 using LegIndexPair = std::pair<Leg, size_t>;
-using LegMatching = std::pair<Leg, RVecSetInt>;
+using LegMatching = std::pair<Leg, RVecTrigObjMask>;
 using RVecMatching = ROOT::VecOps::RVec<LegMatching>;
 
-bool _HasOOMatching(const RVecMatching& legVector, size_t legIndex,
-                    std::set<int>& onlineSelected, std::set<LegIndexPair>& offlineSelected)
+bool _HasOOMatching(const RVecMatching& legVector, size_t legIndex, TrigObjMask& onlineSelected,
+                    std::vector<LegIndexPair>& offlineSelected)
 {
     if(legIndex >= legVector.size()) return true;
-    for(size_t offlineIndex = 0; offlineIndex < legVector[legIndex].second.size(); ++offlineIndex) {
-        const LegIndexPair offlinePair(legVector[legIndex].first, offlineIndex);
-        if(offlineSelected.count(offlinePair)) continue;
-        offlineSelected.insert(offlinePair);
-        for(int onlineIndex : legVector[legIndex].second[offlineIndex]) {
-            if(onlineSelected.count(onlineIndex)) continue;
-            onlineSelected.insert(onlineIndex);
+    const auto& [leg, masks] = legVector[legIndex];
+    for(size_t offlineIndex = 0; offlineIndex < masks.size(); ++offlineIndex) {
+        TrigObjMask candidates = masks[offlineIndex].AndNot(onlineSelected);
+        if(!candidates.Any()) continue;
+        const LegIndexPair offlinePair(leg, offlineIndex);
+        if(std::find(offlineSelected.begin(), offlineSelected.end(), offlinePair) != offlineSelected.end()) continue;
+        offlineSelected.push_back(offlinePair);
+        for(int onlineIndex = candidates.First(); onlineIndex >= 0; onlineIndex = candidates.First()) {
+            candidates.Reset(onlineIndex);
+            onlineSelected.Set(onlineIndex);
             if(_HasOOMatching(legVector, legIndex + 1, onlineSelected, offlineSelected))
                 return true;
-            onlineSelected.erase(onlineIndex);
+            onlineSelected.Reset(onlineIndex);
         }
-        offlineSelected.erase(offlinePair);
+        offlineSelected.pop_back();
     }
     return false;
 }
 
+// Checks that each leg can be assigned to a distinct offline object matched to a distinct trigger object.
 bool HasOOMatching(const RVecMatching& legVector)
 {
-    std::set<int> onlineSelected;
-    std::set<LegIndexPair> offlineSelected;
-
+    for(const auto& [leg, masks] : legVector) {
+        if(std::none_of(masks.begin(), masks.end(), [](const TrigObjMask& mask) { return mask.Any(); }))
+            return false;
+    }
+    TrigObjMask onlineSelected;
+    std::vector<LegIndexPair> offlineSelected;
+    offlineSelected.reserve(legVector.size());
     return _HasOOMatching(legVector, 0, onlineSelected, offlineSelected);
 }
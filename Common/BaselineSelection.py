@@ -3,29 +3,33 @@ import os
 from scipy import stats
 import numpy as np
 import enum
+if __package__ == "Common":
+    import Common.CompileTools as CompileTools
+else:
+    import CompileTools
 
 initialized = False
 
 ana_reco_object_collections = [ "Electron", "Muon", "Tau", "Jet", "FatJet", "boostedTau", "MET", "PuppiMET", "DeepMETResponseTune", "DeepMETResolutionTune"]
 
-def Initialize(loadTF=False, loadHHBtag=False):
+def Initialize(loadTF=False, loadHHBtag=False, load_library=True):
     global initialized
     if not initialized:
         import os
         headers_dir = os.path.dirname(os.path.abspath(__file__))
-        header_path_GenLepton = os.path.join(headers_dir, "GenLepton.h")
-        header_path_Gen = os.path.join(headers_dir, "BaselineGenSelection.h")
-        header_path_Reco = os.path.join(headers_dir, "BaselineRecoSelection.h")
+        header_path_Baseline = os.path.join(headers_dir, "Baseline.h")
         header_path_HHbTag = os.path.join(headers_dir, "HHbTagScores.h")
-        ROOT.gInterpreter.Declare(f'#include "{header_path_GenLepton}"')
-        ROOT.gInterpreter.Declare(f'#include "{header_path_Gen}"')
-        ROOT.gInterpreter.Declare(f'#include "{header_path_Reco}"')
+        if load_library:
+            CompileTools.LoadHeader(header_path_Baseline)
+        else:
+            ROOT.gInterpreter.Declare(f'#include "{header_path_Baseline}"')
         if(loadTF):
             import RunKit.includeCMSSWlibs as IncludeLibs
             IncludeLibs.includeLibTool("tensorflow")
         if(loadHHBtag):
             ROOT.gInterpreter.Declare(f'#include "{header_path_HHbTag}"')
-            ROOT.gROOT.ProcessLine(f'HHBtagWrapper::Initialize("{os.environ["CMSSW_BASE"]}/src/HHTools/HHbtag/models/", 1)')
+            n_slots = max(ROOT.GetThreadPoolSize(), 1)
+            ROOT.gROOT.ProcessLine(f'HHBtagWrapper::Initialize("{os.environ["CMSSW_BASE"]}/src/HHTools/HHbtag/models/", 1, {n_slots})')
         initialized = True
 
 leg_names = [ "Electron", "Muon", "Tau", "boostedTau" ]
@@ -79,10 +83,11 @@ class WorkingPointsBoostedTauVSjet:
 
 def DefineGenObjects(df, isData=False, isHH=False, Hbb_AK4mass_mpv=125., p4_suffix='nano'):
     if isData:
-        df = df.Define("genLeptons", "std::vector<reco_tau::gen_truth::GenLepton>()")
+        df = df.Define("genLeptons", "std::vector<reco_tau::gen_truth::NanoGenLepton>()")
     else:
         df = df.Define("GenPart_daughters", "GetDaughters(GenPart_genPartIdxMother)")
-        df = df.Define("genLeptons", """reco_tau::gen_truth::GenLepton::fromNanoAOD(GenPart_pt, GenPart_eta,
+        df = df.Define("GenPart_ancestry", "GetGenPartAncestry(GenPart_pdgId, GenPart_genPartIdxMother, GenPart_daughters)")
+        df = df.Define("genLeptons", """reco_tau::gen_truth::NanoGenLepton::fromNanoAOD(GenPart_pt, GenPart_eta,
                                         GenPart_phi, GenPart_mass, GenPart_genPartIdxMother, GenPart_pdgId,
                                         GenPart_statusFlags, event)""")
 
@@ -93,8 +98,10 @@ def DefineGenObjects(df, isData=False, isHH=False, Hbb_AK4mass_mpv=125., p4_suff
         return df
 
     if isHH:
+        df = df.Define("GenPart_visibleP4", """GetGenPartVisibleP4(GenPart_pdgId, GenPart_genPartIdxMother, GenPart_daughters,
+                                                                 GenPart_pt, GenPart_eta, GenPart_phi, GenPart_mass)""")
         df = df.Define("genHttCand", """GetGenHTTCandidate(event, GenPart_pdgId, GenPart_daughters, GenPart_statusFlags,
-                                                       GenPart_pt, GenPart_eta, GenPart_phi, GenPart_mass, false)""")
+                                                       GenPart_pt, GenPart_visibleP4, false)""")
         df = df.Define("genHbbIdx", """GetGenHBBIndex(event, GenPart_pdgId, GenPart_daughters, GenPart_statusFlags)""")
         df = df.Define("genHbb_isBoosted", "GenPart_pt[genHbbIdx]>550")
     for var in ["GenJet", "GenJetAK8"]:
@@ -129,12 +136,16 @@ def RequestOnlyResolvedGenJets(df):
 def SelectRecoP4(df, syst_name='nano'):
     for obj in ana_reco_object_collections:
         df = df.Define(f"{obj}_p4", f"{obj}_p4_{syst_name}")
+        if "MET" not in obj:
+            df = df.Define(f"{obj}_pt_sel", f"v_ops::pt({obj}_p4)")
+            df = df.Define(f"{obj}_eta_sel", f"v_ops::eta({obj}_p4)")
+            df = df.Define(f"{obj}_abseta_sel", f"abs({obj}_eta_sel)")
     return df
 
 def CreateRecoP4(df, suffix='nano'):
     df = df.Define(f"TrigObj_idx", f"CreateIndexes(TrigObj_pt.size())")
     df = df.Define("TrigObj_mass", "RVecF(TrigObj_pt.size(), 0.f)")
-    df = df.Define(f"TrigObj_p4", f"GetP4(TrigObj_pt,TrigObj_eta,TrigObj_phi, TrigObj_mass, TrigObj_idx)")
+    df = df.Define(f"TrigObj_p4", f"GetP4Collection(TrigObj_pt,TrigObj_eta,TrigObj_phi, TrigObj_mass, TrigObj_idx)")
     for obj in ana_reco_object_collections:
         if "MET" in obj:
             df = df.Define(f"{obj}_p4_{suffix}", f"LorentzVectorM({obj}_pt, 0., {obj}_phi, 0.)")
@@ -150,17 +161,17 @@ def DefineMETCuts(met_thr, met_collections):
 
 def RecoLeptonsSelection(df, apply_filter=True):
     df = df.Define("Electron_B0", f"""
-        v_ops::pt(Electron_p4) > 18 && abs(v_ops::eta(Electron_p4)) < 2.3 && abs(Electron_dz) < 0.2 && abs(Electron_dxy) < 0.045
+        Electron_pt_sel > 18 && Electron_abseta_sel < 2.3 && abs(Electron_dz) < 0.2 && abs(Electron_dxy) < 0.045
         && (Electron_mvaIso_WP90 || (Electron_mvaNoIso_WP90 && Electron_pfRelIso03_all < 0.5))
     """)
 
     df = df.Define("Muon_B0", f"""
-        v_ops::pt(Muon_p4) > 18 && abs(v_ops::eta(Muon_p4)) < 2.3 && abs(Muon_dz) < 0.2 && abs(Muon_dxy) < 0.045
+        Muon_pt_sel > 18 && Muon_abseta_sel < 2.3 && abs(Muon_dz) < 0.2 && abs(Muon_dxy) < 0.045
         && ( ((Muon_tightId || Muon_mediumId) && Muon_pfRelIso04_all < 0.5) || (Muon_highPtId && Muon_tkRelIso < 0.5) )
     """)
 
     df = df.Define("Tau_B0", f"""
-        v_ops::pt(Tau_p4) > 15 && abs(v_ops::eta(Tau_p4)) < 2.5 && abs(Tau_dz) < 0.2 && Tau_decayMode != 5 && Tau_decayMode != 6
+        Tau_pt_sel > 15 && Tau_abseta_sel < 2.5 && abs(Tau_dz) < 0.2 && Tau_decayMode != 5 && Tau_decayMode != 6
         && (    (    Tau_idDeepTau2017v2p1VSe >= {WorkingPointsTauVSe.VVLoose}
                   && Tau_idDeepTau2017v2p1VSmu >= {WorkingPointsTauVSmu.VLoose}
                   && Tau_idDeepTau2017v2p1VSjet >= {WorkingPointsTauVSjet.VVVLoose} )
@@ -171,7 +182,7 @@ def RecoLeptonsSelection(df, apply_filter=True):
     """)
 
     df = df.Define("boostedTau_B0", f"""
-        v_ops::pt(boostedTau_p4) > 40 && abs(v_ops::eta(boostedTau_p4)) < 2.3 && abs(boostedTau_dz) < 0.2 && boostedTau_decayMode != 5
+        boostedTau_pt_sel > 40 && boostedTau_abseta_sel < 2.3 && abs(boostedTau_dz) < 0.2 && boostedTau_decayMode != 5
         && boostedTau_decayMode != 6 && boostedTau_idMVAnewDM2017v2 >= {WorkingPointsBoostedTauVSjet.VVLoose}
     """)
 
@@ -224,8 +235,8 @@ def RecoLeptonsSelection(df, apply_filter=True):
 
 
 def RecoJetAcceptance(df, apply_filter=True):
-    df = df.Define("Jet_B1", f"v_ops::pt(Jet_p4)>15 && abs(v_ops::eta(Jet_p4)) < 2.5 && ( Jet_jetId & 2 )")
-    df = df.Define("FatJet_B1", "FatJet_msoftdrop > 30 && abs(v_ops::eta(FatJet_p4)) < 2.5")
+    df = df.Define("Jet_B1", f"Jet_pt_sel>15 && Jet_abseta_sel < 2.5 && ( Jet_jetId & 2 )")
+    df = df.Define("FatJet_B1", "FatJet_msoftdrop > 30 && FatJet_abseta_sel < 2.5")
 
     df = df.Define("Lepton_p4_B0", "std::vector<RVecLV>{Electron_p4[Electron_B0], Muon_p4[Muon_B0], Tau_p4[Tau_B0]}")
     df = df.Define("Jet_B1T", "RemoveOverlaps(Jet_p4, Jet_B1, Lepton_p4_B0, 2, 0.5)")
@@ -243,60 +254,60 @@ def RecoHttCandidateSelection(df):
            .Define("Muon_iso", "Muon_pfRelIso04_all") \
            .Define("Tau_iso", "-Tau_rawDeepTau2017v2p1VSjet")
 
-    df = df.Define("Electron_B2_eTau_1", f"Electron_B0 && v_ops::pt(Electron_p4) > 20 && Electron_mvaIso_WP80")
+    df = df.Define("Electron_B2_eTau_1", f"Electron_B0 && Electron_pt_sel > 20 && Electron_mvaIso_WP80")
     df = df.Define("Tau_B2_eTau_2", f"""
-        Tau_B0 && v_ops::pt(Tau_p4) > 20
+        Tau_B0 && Tau_pt_sel > 20
         && (Tau_idDeepTau2017v2p1VSe >= {WorkingPointsTauVSe.VLoose})
         && (Tau_idDeepTau2017v2p1VSmu >= {WorkingPointsTauVSmu.Tight})
     """)
 
     df = df.Define("Muon_B2_muTau_1", f"""
-        Muon_B0 && v_ops::pt(Muon_p4) > 20 && (   (Muon_tightId && Muon_pfRelIso04_all < 0.15)
+        Muon_B0 && Muon_pt_sel > 20 && (   (Muon_tightId && Muon_pfRelIso04_all < 0.15)
                                     || (Muon_highPtId && Muon_tkRelIso < 0.15) )
     """)
     df = df.Define("Tau_B2_muTau_2", f"""
-        Tau_B0 && v_ops::pt(Tau_p4) > 20
+        Tau_B0 && Tau_pt_sel > 20
         && (Tau_idDeepTau2017v2p1VSe >= {WorkingPointsTauVSe.VLoose})
         && (Tau_idDeepTau2017v2p1VSmu >= {WorkingPointsTauVSmu.Tight})
     """)
 
     df = df.Define("Tau_B2_tauTau_1", f"""
-        Tau_B0 && v_ops::pt(Tau_p4) > 20
+        Tau_B0 && Tau_pt_sel > 20
         && (Tau_idDeepTau2017v2p1VSe >= {WorkingPointsTauVSe.VVLoose})
         && (Tau_idDeepTau2017v2p1VSmu >= {WorkingPointsTauVSmu.VLoose})
         && (Tau_idDeepTau2017v2p1VSjet >= {WorkingPointsTauVSjet.Medium})
     """)
 
     df = df.Define("Tau_B2_tauTau_2", f"""
-        Tau_B0 && v_ops::pt(Tau_p4) > 20
+        Tau_B0 && Tau_pt_sel > 20
         && (Tau_idDeepTau2017v2p1VSe >= {WorkingPointsTauVSe.VVLoose})
         && (Tau_idDeepTau2017v2p1VSmu >= {WorkingPointsTauVSmu.VLoose})
     """)
 
     df = df.Define("Muon_B2_muMu_1", f"""
-        Muon_B0 && v_ops::pt(Muon_p4) > 20 && (   (Muon_tightId && Muon_pfRelIso04_all < 0.15)
+        Muon_B0 && Muon_pt_sel > 20 && (   (Muon_tightId && Muon_pfRelIso04_all < 0.15)
                                     || (Muon_highPtId && Muon_tkRelIso < 0.15) )
     """)
     df = df.Define("Muon_B2_muMu_2", f"""
-        Muon_B0 && v_ops::pt(Muon_p4) > 20 && (   (Muon_tightId && Muon_pfRelIso04_all < 0.3)
+        Muon_B0 && Muon_pt_sel > 20 && (   (Muon_tightId && Muon_pfRelIso04_all < 0.3)
                                     || (Muon_highPtId && Muon_tkRelIso < 0.3) )
     """)
-    #df.Define("Mu_pt", "v_ops::pt(Muon_p4)").Define("Mu_sel_pt", "Mu_pt[Muon_B2_muMu_2]").Display("Mu_sel_pt").Print()
+    #df.Define("Mu_pt", "Muon_pt_sel").Define("Mu_sel_pt", "Mu_pt[Muon_B2_muMu_2]").Display("Mu_sel_pt").Print()
 
     df = df.Define("Electron_B2_eMu_1", f"""
-        Electron_B0 && v_ops::pt(Electron_p4) > 20 && Electron_mvaNoIso_WP80 && Electron_pfRelIso03_all < 0.3
+        Electron_B0 && Electron_pt_sel > 20 && Electron_mvaNoIso_WP80 && Electron_pfRelIso03_all < 0.3
     """)
     df = df.Define("Muon_B2_eMu_2", f"""
-        Muon_B0 && v_ops::pt(Muon_p4) > 20 && (   (Muon_tightId && Muon_pfRelIso04_all < 0.15)
+        Muon_B0 && Muon_pt_sel > 20 && (   (Muon_tightId && Muon_pfRelIso04_all < 0.15)
                                     || (Muon_highPtId && Muon_tkRelIso < 0.15) )
     """)
 
     df = df.Define("Electron_B2_eE_1", f"""
-        Electron_B0 && v_ops::pt(Electron_p4) > 20
+        Electron_B0 && Electron_pt_sel > 20
         && (Electron_mvaIso_WP80 || Electron_mvaNoIso_WP80 && Electron_pfRelIso03_all < 0.15)
     """)
     df = df.Define("Electron_B2_eE_2", f"""
-        Electron_B0 && v_ops::pt(Electron_p4) > 20 && Electron_mvaNoIso_WP80 && Electron_pfRelIso03_all < 0.3
+        Electron_B0 && Electron_pt_sel > 20 && Electron_mvaNoIso_WP80 && Electron_pfRelIso03_all < 0.3
     """)
 
     cand_columns = []
@@ -315,12 +326,12 @@ def RecoHttCandidateSelection(df):
 
 def ThirdLeptonVeto(df):
     df = df.Define("Electron_vetoSel",
-                   f"""v_ops::pt(Electron_p4) > 10 && abs(v_ops::eta(Electron_p4)) < 2.5 && abs(Electron_dz) < 0.2 && abs(Electron_dxy) < 0.045
+                   f"""Electron_pt_sel > 10 && Electron_abseta_sel < 2.5 && abs(Electron_dz) < 0.2 && abs(Electron_dxy) < 0.045
                       && ( Electron_mvaIso_WP90 == true || ( Electron_mvaNoIso_WP90 && Electron_pfRelIso03_all<0.3) )
                      && (httCand.isLeg(Electron_idx, Leg::e)== false)""")
     df = df.Filter("Electron_idx[Electron_vetoSel].size() == 0", "No extra electrons")
     df = df.Define("Muon_vetoSel",
-                   f"""v_ops::pt(Muon_p4) > 10 && abs(v_ops::eta(Muon_p4)) < 2.5 && abs(Muon_dz) < 0.2 && abs(Muon_dxy) < 0.045
+                   f"""Muon_pt_sel > 10 && Muon_abseta_sel < 2.5 && abs(Muon_dz) < 0.2 && abs(Muon_dxy) < 0.045
                       && ( Muon_mediumId || Muon_tightId ) && Muon_pfRelIso04_all<0.3
                       && (httCand.isLeg(Muon_idx, Leg::mu) == false)""")
     df = df.Filter("Muon_idx[Muon_vetoSel].size() == 0", "No extra muons")
@@ -342,6 +353,6 @@ def GenRecoJetMatching(df):
     return df.Filter("Jet_genJetIdx_matched[Jet_genMatched].size()>=2", "Two different gen-reco jet matches at least")
 
 def DefineHbbCand(df):
-    df = df.Define("Jet_HHBtagScore", "GetHHBtagScore(Jet_B3T, Jet_idx, Jet_p4,Jet_btagDeepFlavB, MET_pt,  MET_phi, httCand, period, event)")
+    df = df.Define("Jet_HHBtagScore", "GetHHBtagScore(rdfslot_, Jet_B3T, Jet_idx, Jet_p4,Jet_btagDeepFlavB, MET_pt,  MET_phi, httCand, period, event)")
     df = df.Define("HbbCandidate", "GetHbbCandidate(Jet_HHBtagScore, Jet_B3T, Jet_p4, Jet_idx)")
     return df
\ No newline at end of file
@@ -0,0 +1,331 @@
+import atexit
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import ROOT
+
+def GetBuildDir():
+    build_dir = os.environ.get('ANALYSIS_BUILD_PATH', None)
+    if build_dir is None:
+        data_path = os.environ.get('ANALYSIS_DATA_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data'))
+        build_dir = os.path.join(data_path, 'build')
+    return os.path.abspath(build_dir)
+
+def LocalIncludes(header_path):
+    # headers included with quotes are looked up next to the including header, which also holds in the CRAB job
+    # directory where all shipped files are flattened
+    headers = []
+    to_visit = [ os.path.abspath(header_path) ]
+    while len(to_visit) > 0:
+        header = to_visit.pop()
+        if header in headers: continue
+        headers.append(header)
+        with open(header, 'r') as f:
+            for include in re.findall(r'^\s*#\s*include\s*"([^"]+)"', f.read(), re.MULTILINE):
+                include_path = os.path.normpath(os.path.join(os.path.dirname(header), include))
+                if os.path.exists(include_path):
+                    to_visit.append(include_path)
+    return sorted(headers, key=os.path.basename)
+
+def LibraryHash(header_path):
+    h = hashlib.sha1(ROOT.gROOT.GetVersion().encode())
+    for header in LocalIncludes(header_path):
+        h.update(os.path.basename(header).encode())
+        with open(header, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def LibraryName(header_path):
+    return os.path.splitext(os.path.basename(header_path))[0]
+
+def FindLibrary(header_path, lib_dirs, lib_hash=None):
+    name = LibraryName(header_path)
+    if lib_hash is None:
+        lib_hash = LibraryHash(header_path)
+    for lib_dir in lib_dirs:
+        stamp_file = os.path.join(lib_dir, f'{name}.json')
+        if not os.path.exists(stamp_file): continue
+        with open(stamp_file, 'r') as f:
+            stamp = json.load(f)
+        lib_file = os.path.join(lib_dir, stamp['library'])
+        if stamp['hash'] == lib_hash and os.path.exists(lib_file):
+            return lib_file
+    return None
+
+def BuildLibrary(header_path, build_dir=None, info=None):
+    """Compiles the header with ACLiC and publishes the library in build_dir/<header name>. The library is built in
+    a temporary directory and its stamp is written last, then the directory is renamed and the link to it replaced,
+    so a job never sees a partially written build."""
+    if build_dir is None:
+        build_dir = GetBuildDir()
+    header_path = os.path.abspath(header_path)
+    name = LibraryName(header_path)
+    lib_hash = LibraryHash(header_path)
+    os.makedirs(build_dir, exist_ok=True)
+    version_dir = os.path.join(build_dir, f'{name}-{lib_hash[:16]}')
+    with open(os.path.join(build_dir, f'.{name}.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if FindLibrary(header_path, [ version_dir ], lib_hash) is None:
+            tmp_dir = tempfile.mkdtemp(prefix=f'.{name}-', dir=build_dir)
+            os.chmod(tmp_dir, 0o755)
+            ROOT.gSystem.SetBuildDir(tmp_dir, True)
+            ROOT.gSystem.AddIncludePath(f"-I{os.path.dirname(header_path)}")
+            if ROOT.gSystem.CompileMacro(header_path, "kO") != 1:
+                shutil.rmtree(tmp_dir)
+                print(f"Unable to compile {header_path}.")
+                return False
+            with open(os.path.join(tmp_dir, f'{name}.json'), 'w') as f:
+                json.dump({ 'hash': lib_hash, 'library': f'{name}_h.so', **(info or {}) }, f)
+            if os.path.exists(version_dir):
+                shutil.rmtree(version_dir)
+            os.rename(tmp_dir, version_dir)
+        tmp_link = os.path.join(build_dir, f'.{name}.link')
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.basename(version_dir), tmp_link)
+        os.replace(tmp_link, os.path.join(build_dir, name))
+    return True
+
+def LoadHeader(header_path, build_dir=None):
+    # Jobs never compile: the library is built beforehand by BuildLibrary, and shipped next to the header for the
+    # CRAB jobs. If it is missing or was built from other headers, the header is declared to the interpreter.
+    if build_dir is None:
+        build_dir = GetBuildDir()
+    header_path = os.path.abspath(header_path)
+    lib_dirs = [ os.path.dirname(header_path), os.path.join(build_dir, LibraryName(header_path)) ]
+    lib_file = FindLibrary(header_path, lib_dirs)
+    loaded = lib_file is not None and ROOT.gSystem.Load(lib_file) >= 0
+    if not loaded:
+        print(f"No up-to-date library for {header_path}. Falling back to the interpreter.")
+    ROOT.gInterpreter.Declare(f'#include "{header_path}"')
+    return loaded
+
+class ExpressionCache:
+    # Each string passed to Define/Filter is turned into a named C++ function and a function that books it on a
+    # dataframe as a typed callable with an explicit list of columns. On a cache hit the booking function is loaded
+    # from the combined library of all known expressions, which is built outside of the jobs by BuildExpressionLibrary.
+    # On a miss it is jitted, and the expressions of the job are saved at exit as a pending set for the next build.
+    special_columns = { 'rdfentry_': 'ULong64_t', 'rdfslot_': 'unsigned int' }
+    library_name = 'Expressions'
+    declared = set()
+
+    def __init__(self, headers, cache_dir=None):
+        self.headers = [ os.path.abspath(h) for h in headers ]
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(GetBuildDir(), 'expressions')
+        self.headers_hash = None
+        self.library = None
+        self.pending = {}
+        self.n_hits = 0
+        self.n_misses = 0
+        self.jit_time = 0.
+        self.load_time = 0.
+        self.time_saved = 0.
+
+    def _HeadersHash(self):
+        if self.headers_hash is None:
+            h = hashlib.sha1(ROOT.gROOT.GetVersion().encode())
+            headers_dir = os.path.dirname(os.path.abspath(__file__))
+            for header in sorted(glob.glob(os.path.join(headers_dir, '*.h'))) + self.headers:
+                with open(header, 'rb') as f:
+                    h.update(f.read())
+            self.headers_hash = h.hexdigest()
+        return self.headers_hash
+
+    @staticmethod
+    def FindColumns(df, expr):
+        # identifiers that follow '.', '->' or '::' are members or namespaced names, not columns
+        column_names = set(str(c) for c in df.GetColumnNames())
+        columns = []
+        for name in re.findall(r'(?<![\w.])(?<!->)(?<!::)([A-Za-z_]\w*)', expr):
+            if (name in column_names or name in ExpressionCache.special_columns) and name not in columns:
+                columns.append(name)
+        return columns
+
+    @staticmethod
+    def _BookingSignature(fn_name, kind):
+        return f'ROOT::RDF::RNode {fn_name}_{kind}(ROOT::RDF::RNode df, const std::string& name)'
+
+    def _Source(self, df, expr, kind):
+        columns = self.FindColumns(df, expr)
+        column_types = [ self.special_columns.get(c, None) or str(df.GetColumnType(c)) for c in columns ]
+        args = ', '.join(f'const {t}& {c}' for c, t in zip(columns, column_types))
+        body = expr if re.search(r'\breturn\b', expr) else f'return {expr};'
+        column_list = ', '.join(f'"{c}"' for c in columns)
+        return_type = 'bool' if kind == 'Filter' else 'auto'
+        book_args = f'_FN_, {{ {column_list} }}' + (', name' if kind == 'Filter' else '')
+        code = f'''{return_type} _FN_({args}) {{
+{body}
+}}
+
+{self._BookingSignature('_FN_', kind)} {{
+  return df.{kind}({'' if kind == 'Filter' else 'name, '}{book_args});
+}}
+'''
+        fn_name = '_cached_expr_' + hashlib.sha1((code + self._HeadersHash()).encode()).hexdigest()[:16]
+        return fn_name, code.replace('_FN_', fn_name)
+
+    @staticmethod
+    def _Includes(headers):
+        return ''.join(f'#include "{h}"\n' for h in [ 'ROOT/RDataFrame.hxx' ] + headers)
+
+    def _LoadLibrary(self):
+        # the library shipped with the CRAB jobs is next to this file, otherwise it is taken from the cache
+        self.library = {}
+        lib_dirs = [ os.path.dirname(os.path.abspath(__file__)), os.path.join(self.cache_dir, self.library_name) ]
+        for lib_dir in lib_dirs:
+            # a new build replaces the link, but never modifies the directory it points to
+            lib_dir = os.path.realpath(lib_dir)
+            stamp_file = os.path.join(lib_dir, f'{self.library_name}.json')
+            if not os.path.exists(stamp_file): continue
+            with open(stamp_file, 'r') as f:
+                stamp = json.load(f)
+            start = time.time()
+            if ROOT.gSystem.Load(os.path.join(lib_dir, stamp['library'])) >= 0:
+                self.library = stamp['expressions']
+            else:
+                print(f"Unable to load the expression library from {lib_dir}.")
+            self.load_time += time.time() - start
+            return
+
+    def _Declare(self, fn_name, kind, code):
+        if fn_name in ExpressionCache.declared: return
+        if self.library is None:
+            self._LoadLibrary()
+        start = time.time()
+        if fn_name in self.library:
+            # only the booking function is declared, its definition is found in the loaded library
+            if not ROOT.gInterpreter.Declare(self._BookingSignature(fn_name, kind) + ';'):
+                raise RuntimeError(f"Unable to declare the cached expression {fn_name}.")
+            elapsed = time.time() - start
+            self.n_hits += 1
+            self.load_time += elapsed
+            self.time_saved += max(self.library[fn_name]['jit_time'] - elapsed, 0.)
+        else:
+            if not ROOT.gInterpreter.Declare(self._Includes(self.headers) + code):
+                raise RuntimeError(f"Unable to declare the cached expression {fn_name}:\n{code}")
+            elapsed = time.time() - start
+            self.n_misses += 1
+            self.jit_time += elapsed
+            self.pending[fn_name] = { 'kind': kind, 'code': code, 'jit_time': elapsed }
+        ExpressionCache.declared.add(fn_name)
+
+    def Book(self, df, kind, name, expr):
+        fn_name, code = self._Source(df, expr, kind)
+        self._Declare(fn_name, kind, code)
+        return getattr(ROOT, f'{fn_name}_{kind}')(ROOT.RDF.AsRNode(df), name)
+
+    def Wrap(self, df):
+        return CachedNode(df, self)
+
+    def WritePending(self):
+        """Saves the expressions jitted in this job, to be added to the library by the next BuildExpressionLibrary."""
+        if len(self.pending) == 0: return
+        pending_dir = os.path.join(self.cache_dir, 'pending')
+        os.makedirs(pending_dir, exist_ok=True)
+        set_hash = hashlib.sha1(''.join(sorted(self.pending)).encode()).hexdigest()
+        with tempfile.NamedTemporaryFile('w', dir=pending_dir, suffix='.tmp', delete=False) as f:
+            json.dump({ 'headers': self.headers, 'expressions': self.pending }, f)
+        os.replace(f.name, os.path.join(pending_dir, f'{set_hash}.json'))
+
+    def PrintReport(self):
+        print(f"Expression cache: {self.n_hits} hits, {self.n_misses} misses, jit time = {self.jit_time:.1f} s, "
+              f"load time = {self.load_time:.1f} s, time saved = {self.time_saved:.1f} s")
+
+    def Finalize(self):
+        self.WritePending()
+        self.PrintReport()
+
+
+def BuildExpressionLibrary(cache_dir=None):
+    """Compiles the expressions already in the library together with the pending sets saved by the jobs into a
+    single library. The sets are merged under a lock file, and the library is published by BuildLibrary."""
+    if cache_dir is None:
+        cache_dir = os.path.join(GetBuildDir(), 'expressions')
+    name = ExpressionCache.library_name
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, '.merge.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        pending_files = sorted(glob.glob(os.path.join(cache_dir, 'pending', '*.json')))
+        if len(pending_files) == 0:
+            return True
+        headers = []
+        expressions = {}
+        stamp_file = os.path.join(cache_dir, name, f'{name}.json')
+        if os.path.exists(stamp_file):
+            with open(stamp_file, 'r') as f:
+                stamp = json.load(f)
+            headers.extend(stamp['headers'])
+            expressions.update(stamp['expressions'])
+        for pending_file in pending_files:
+            with open(pending_file, 'r') as f:
+                pending = json.load(f)
+            headers.extend(h for h in pending['headers'] if h not in headers)
+            for fn_name, info in pending['expressions'].items():
+                expressions.setdefault(fn_name, info)
+        work_dir = tempfile.mkdtemp(prefix='.work-', dir=cache_dir)
+        try:
+            header_path = os.path.join(work_dir, f'{name}.h')
+            with open(header_path, 'w') as f:
+                f.write(ExpressionCache._Includes(headers) + '\n')
+                for fn_name in sorted(expressions):
+                    f.write(expressions[fn_name]['code'] + '\n')
+            built = BuildLibrary(header_path, build_dir=cache_dir,
+                                 info={ 'headers': headers, 'expressions': expressions })
+        finally:
+            shutil.rmtree(work_dir)
+        if built:
+            for pending_file in pending_files:
+                os.remove(pending_file)
+        return built
+
+
+class CachedNode:
+    def __init__(self, node, cache):
+        self.node = node
+        self.cache = cache
+
+    def Define(self, name, expr):
+        return CachedNode(self.cache.Book(self.node, 'Define', name, expr), self.cache)
+
+    def Filter(self, expr, name=''):
+        return CachedNode(self.cache.Book(self.node, 'Filter', name, expr), self.cache)
+
+    def __getattr__(self, attr):
+        return getattr(self.node, attr)
+
+
+_expression_cache = None
+
+def UseExpressionCache():
+    return os.environ.get('ANALYSIS_EXPRESSION_CACHE', '0') not in [ '', '0' ]
+
+def GetExpressionCache():
+    global _expression_cache
+    if _expression_cache is None:
+        headers_dir = os.path.dirname(os.path.abspath(__file__))
+        _expression_cache = ExpressionCache([ os.path.join(headers_dir, "Baseline.h") ])
+        atexit.register(_expression_cache.Finalize)
+    return _expression_cache
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Build the libraries loaded by the jobs.')
+    parser.add_argument('--build-dir', required=False, type=str, default=None,
+                        help='output directory, $ANALYSIS_BUILD_PATH or $ANALYSIS_DATA_PATH/build by default')
+    parser.add_argument('headers', type=str, nargs='*',
+                        default=[ os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Baseline.h') ])
+    args = parser.parse_args()
+    ROOT.gROOT.SetBatch(True)
+    build_dir = args.build_dir if args.build_dir is not None else GetBuildDir()
+    built = [ BuildLibrary(header, build_dir=build_dir) for header in args.headers ]
+    built.append(BuildExpressionLibrary(os.path.join(build_dir, 'expressions')))
+    if not all(built):
+        sys.exit(1)
@@ -0,0 +1,176 @@
+import os
+import numpy as np
+import ROOT
+
+if __package__ == "Common":
+    from Common.EventKeys import MakeKeys, SplitKeys, key_dtype
+else:
+    from EventKeys import MakeKeys, SplitKeys, key_dtype
+
+def DefaultIndexPath(inputFile):
+    return inputFile + '.evtidx.npz'
+
+def ParseEventIds(evtIds):
+    """Parses comma separated event ids, each given as event or run:lumi:event."""
+    ids = []
+    for evtId in evtIds.split(','):
+        evtId = evtId.strip()
+        if len(evtId) == 0: continue
+        parts = [ int(x) for x in evtId.split(':') ]
+        if len(parts) == 1:
+            ids.append((None, None, parts[0]))
+        elif len(parts) == 3:
+            ids.append(tuple(parts))
+        else:
+            raise RuntimeError(f'Invalid event id "{evtId}". Expected event or run:lumi:event.')
+    return ids
+
+class EventIndex:
+    """Sorted (run, lumi, event) -> (file, entry) index of a dataset.
+    The index is stored as a sidecar npz file and is considered as outdated if any of the indexed files
+    has been modified after its creation."""
+
+    def __init__(self, files, keys, file_ids, entries, file_stats, treeName='Events'):
+        self.files = list(files)
+        self.keys = keys
+        self.file_ids = file_ids
+        self.entries = entries
+        self.file_stats = file_stats
+        self.treeName = treeName
+
+    @staticmethod
+    def Build(files, treeName='Events'):
+        all_keys, all_file_ids, all_entries = [], [], []
+        for file_id, file in enumerate(files):
+            columns = ROOT.RDataFrame(treeName, file).AsNumpy(columns=[ 'run', 'luminosityBlock', 'event' ])
+            n = len(columns['event'])
+            all_keys.append(MakeKeys(columns['run'], columns['luminosityBlock'], columns['event']))
+            all_file_ids.append(np.full(n, file_id, dtype=np.uint32))
+            all_entries.append(np.arange(n, dtype=np.uint64))
+        keys = np.concatenate(all_keys) if len(all_keys) > 0 else np.empty(0, dtype=key_dtype)
+        order = np.argsort(keys, kind='stable')
+        file_ids = np.concatenate(all_file_ids)[order] if len(all_file_ids) > 0 else np.empty(0, dtype=np.uint32)
+        entries = np.concatenate(all_entries)[order] if len(all_entries) > 0 else np.empty(0, dtype=np.uint64)
+        file_stats = np.array([ EventIndex._FileStat(file) for file in files ], dtype=np.float64).reshape(-1, 2)
+        return EventIndex(files, keys[order], file_ids, entries, file_stats, treeName)
+
+    @staticmethod
+    def _FileStat(file):
+        if not os.path.exists(file):
+            return [ -1, -1 ]
+        stat = os.stat(file)
+        return [ stat.st_size, stat.st_mtime ]
+
+    def Save(self, path):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, files=np.array(self.files), key_hi=self.keys['hi'], key_lo=self.keys['lo'],
+                 file_ids=self.file_ids, entries=self.entries, file_stats=self.file_stats,
+                 treeName=np.array(self.treeName))
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def Load(path, checkFiles=True):
+        data = np.load(path)
+        keys = np.empty(len(data['key_hi']), dtype=key_dtype)
+        keys['hi'] = data['key_hi']
+        keys['lo'] = data['key_lo']
+        index = EventIndex([ str(f) for f in data['files'] ], keys, data['file_ids'], data['entries'],
+                           data['file_stats'], str(data['treeName']))
+        if checkFiles and not index.IsUpToDate():
+            raise RuntimeError(f'Event index {path} is outdated.')
+        return index
+
+    def IsUpToDate(self):
+        return all(list(self.file_stats[n]) == self._FileStat(file) for n, file in enumerate(self.files))
+
+    def FileId(self, file):
+        file_path = os.path.abspath(file)
+        for file_id, indexed_file in enumerate(self.files):
+            if indexed_file == file or os.path.abspath(indexed_file) == file_path:
+                return file_id
+        raise RuntimeError(f'{file} is not in the event index.')
+
+    def Find(self, eventIds, file=None):
+        """Returns positions in the index of the events with the given ids (see ParseEventIds).
+        Ids with run and lumi are looked up by a binary search, ids with only the event number by a scan.
+        If file is given, only the events stored in this file are returned."""
+        positions = []
+        event_only = []
+        for run, lumi, event in eventIds:
+            if run is None:
+                event_only.append(event)
+                continue
+            key = MakeKeys([ run ], [ lumi ], [ event ])[0]
+            hi_begin = np.searchsorted(self.keys['hi'], key['hi'], side='left')
+            hi_end = np.searchsorted(self.keys['hi'], key['hi'], side='right')
+            lo = self.keys['lo'][hi_begin:hi_end]
+            begin = np.searchsorted(lo, key['lo'], side='left')
+            end = np.searchsorted(lo, key['lo'], side='right')
+            positions.extend(range(hi_begin + begin, hi_begin + end))
+        if len(event_only) > 0:
+            positions.extend(np.nonzero(np.isin(self.keys['lo'], np.array(event_only, dtype=np.uint64)))[0])
+        positions = np.unique(np.array(positions, dtype=np.int64))
+        if file is not None:
+            positions = positions[self.file_ids[positions] == self.FileId(file)]
+        return positions
+
+    def Lookup(self, eventIds, file=None):
+        """Returns list of (run, lumi, event, file, entry) for the given ids."""
+        positions = self.Find(eventIds, file=file)
+        run, lumi, event = SplitKeys(self.keys[positions])
+        return [ (int(run[n]), int(lumi[n]), int(event[n]), self.files[self.file_ids[p]], int(self.entries[p]))
+                 for n, p in enumerate(positions) ]
+
+    def EntryRanges(self, eventIds, file=None):
+        """Returns { file: [ (begin, end), ... ] } with sorted ranges of consecutive entries, end excluded."""
+        positions = self.Find(eventIds, file=file)
+        ranges = {}
+        for file_id in np.unique(self.file_ids[positions]):
+            entries = np.sort(self.entries[positions][self.file_ids[positions] == file_id]).astype(np.int64)
+            breaks = np.nonzero(np.diff(entries) != 1)[0] + 1
+            ranges[self.files[file_id]] = [ (int(chunk[0]), int(chunk[-1]) + 1)
+                                            for chunk in np.split(entries, breaks) ]
+        return ranges
+
+    def MakeEntryList(self, entryRanges):
+        entryList = ROOT.TEntryList('eventIndex', 'eventIndex')
+        for file, file_ranges in entryRanges.items():
+            for begin, end in file_ranges:
+                for entry in range(begin, end):
+                    entryList.Enter(entry, self.treeName, file)
+        return entryList
+
+    def MakeDataFrame(self, eventIds, file=None):
+        """Returns a dataframe that reads only the entries of the requested events, together with the chain
+        and the entry list that should be kept alive while the dataframe is used.
+        rdfentry_ of this dataframe is not the entry number in the input file: use Lookup to get it."""
+        entryRanges = self.EntryRanges(eventIds, file=file)
+        if len(entryRanges) == 0:
+            where = f' in {file}' if file is not None else ''
+            ids = ', '.join(':'.join(str(x) for x in evtId if x is not None) for evtId in eventIds)
+            raise RuntimeError(f'Event(s) {ids} not found in the event index{where}.')
+        entryList = self.MakeEntryList(entryRanges)
+        chain = ROOT.TChain(self.treeName)
+        for input_file in entryRanges.keys():
+            chain.Add(input_file)
+        chain.SetEntryList(entryList)
+        return ROOT.RDataFrame(chain), (chain, entryList)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Build or query the run/lumi/event index of a dataset.')
+    parser.add_argument('--index', required=True, type=str, help='path to the index file')
+    parser.add_argument('--treeName', required=False, type=str, default='Events')
+    parser.add_argument('--lookup', required=False, type=str, default=None,
+                        help='comma separated event ids (event or run:lumi:event) to look up in an existing index')
+    parser.add_argument('inputFiles', nargs='*', type=str)
+    args = parser.parse_args()
+
+    if args.lookup is None:
+        index = EventIndex.Build(args.inputFiles, treeName=args.treeName)
+        index.Save(args.index)
+        print(f'{len(index.keys)} events from {len(index.files)} files indexed in {args.index}')
+    else:
+        index = EventIndex.Load(args.index)
+        for run, lumi, event, file, entry in index.Lookup(ParseEventIds(args.lookup)):
+            print(f'{run}:{lumi}:{event} {file} {entry}')
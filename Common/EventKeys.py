@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+
+# (run, luminosityBlock, event) packed into a 128-bit key: hi = run << 32 | luminosityBlock, lo = event.
+# Sorting the keys is equivalent to sorting by (run, luminosityBlock, event).
+key_dtype = np.dtype([ ('hi', np.uint64), ('lo', np.uint64) ])
+
+def MakeKeys(run, lumi, event):
+    keys = np.empty(len(event), dtype=key_dtype)
+    keys['hi'] = (np.asarray(run).astype(np.uint64) << np.uint64(32)) | np.asarray(lumi).astype(np.uint64)
+    keys['lo'] = np.asarray(event).astype(np.uint64)
+    return keys
+
+def SplitKeys(keys):
+    run = (keys['hi'] >> np.uint64(32)).astype(np.uint32)
+    lumi = (keys['hi'] & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+    return run, lumi, keys['lo']
+
+def KeyBuckets(keys, n_buckets):
+    h = (keys['lo'] * np.uint64(0x9E3779B97F4A7C15)) ^ keys['hi']
+    h ^= h >> np.uint64(29)
+    return (h % np.uint64(n_buckets)).astype(np.int64)
+
+class UniqueKeyCounter:
+    """Counts unique event keys with a bounded memory usage.
+    Keys are added chunk by chunk and hash-partitioned into temporary bucket files, so that all copies of a key end
+    up in the same bucket. Each bucket is then deduplicated separately with np.unique."""
+
+    def __init__(self, n_buckets=1, tmp_dir=None):
+        self.n_buckets = max(n_buckets, 1)
+        self.n_total = 0
+        self.chunks = []
+        self.tmp_dir = None
+        self.bucket_files = []
+        if self.n_buckets > 1:
+            self.tmp_dir = tempfile.mkdtemp(prefix='event_keys_', dir=tmp_dir)
+            self.bucket_files = [ open(os.path.join(self.tmp_dir, f'bucket_{n}.bin'), 'wb')
+                                  for n in range(self.n_buckets) ]
+
+    def Add(self, keys):
+        self.n_total += len(keys)
+        if self.n_buckets == 1:
+            self.chunks.append(keys)
+            return
+        buckets = KeyBuckets(keys, self.n_buckets)
+        order = np.argsort(buckets, kind='stable')
+        boundaries = np.cumsum(np.bincount(buckets, minlength=self.n_buckets))
+        start = 0
+        for bucket_id, end in enumerate(boundaries):
+            if end > start:
+                keys[order[start:end]].tofile(self.bucket_files[bucket_id])
+            start = end
+
+    def _Buckets(self):
+        if self.n_buckets == 1:
+            yield np.concatenate(self.chunks) if len(self.chunks) > 0 else np.empty(0, dtype=key_dtype)
+            self.chunks = []
+            return
+        for bucket_file in self.bucket_files:
+            bucket_file.close()
+        for bucket_file in self.bucket_files:
+            yield np.fromfile(bucket_file.name, dtype=key_dtype)
+            os.remove(bucket_file.name)
+
+    def Finalize(self):
+        """Returns the number of unique keys, the duplicated keys and their multiplicities."""
+        n_unique = 0
+        duplicates, multiplicities = [], []
+        try:
+            for keys in self._Buckets():
+                unique_keys, counts = np.unique(keys, return_counts=True)
+                n_unique += len(unique_keys)
+                duplicates.append(unique_keys[counts > 1])
+                multiplicities.append(counts[counts > 1])
+        finally:
+            self.Close()
+        duplicates = np.concatenate(duplicates) if len(duplicates) > 0 else np.empty(0, dtype=key_dtype)
+        multiplicities = np.concatenate(multiplicities) if len(multiplicities) > 0 else np.empty(0, dtype=np.int64)
+        order = np.argsort(duplicates)
+        return n_unique, duplicates[order], multiplicities[order]
+
+    def Close(self):
+        for bucket_file in self.bucket_files:
+            bucket_file.close()
+        if self.tmp_dir is not None and os.path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        self.tmp_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
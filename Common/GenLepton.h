@@ -4,13 +4,19 @@ Author: Konstantin Androsov
 
 #pragma once
 
+#include <algorithm>
 #include <bitset>
+#include <iostream>
+#include <map>
+#include <set>
 
 #include <Math/LorentzVector.h>
 #include <Math/PtEtaPhiM4D.h>
 #include <Math/Point3D.h>
 #include <Math/GenVector/Cartesian3D.h>
 
+#include "GenStatusFlags.h"
+
 
 namespace reco_tau {
 namespace gen_truth {
@@ -599,5 +605,215 @@ private:
            nFinalStateNeutrinos_{0};
 };
 
+// Summary of a generator-level lepton built directly from the NanoAOD GenPart collection.
+// It provides the same summary quantities as GenLepton::fromNanoAOD, but does not store the particle tree, and all
+// intermediate buffers are reused between the events processed by the same thread.
+class NanoGenLepton {
+public:
+    using Kind = GenLepton::Kind;
+
+    template<typename IntVector, typename FloatVector>
+    static std::vector<NanoGenLepton> fromNanoAOD(const FloatVector& GenPart_pt,
+                                                  const FloatVector& GenPart_eta,
+                                                  const FloatVector& GenPart_phi,
+                                                  const FloatVector& GenPart_mass,
+                                                  const IntVector& GenPart_genPartIdxMother,
+                                                  const IntVector& GenPart_pdgId,
+                                                  const IntVector& GenPart_statusFlags,
+                                                  int event=0)
+    {
+        try {
+            auto& buffers = GetBuffers();
+            const size_t n_parts = GenPart_pdgId.size();
+            buffers.Reset(GenPart_genPartIdxMother, GenPart_pdgId);
+
+            std::vector<NanoGenLepton> genLeptons;
+            for(size_t genPart_idx = 0; genPart_idx < n_parts; ++genPart_idx) {
+                if(buffers.IsProcessed(genPart_idx)) continue;
+                const GenStatusFlags particle_statusFlags(GenPart_statusFlags[genPart_idx]);
+                if(!(particle_statusFlags.isPrompt() && particle_statusFlags.isFirstCopy())) continue;
+                const int abs_pdg = std::abs(GenPart_pdgId[genPart_idx]);
+                if(!GenParticle::ChargedLeptons().count(static_cast<GenParticle::PdgId>(abs_pdg)))
+                    continue;
+                NanoGenLepton lepton;
+                lepton.Fill(buffers, genPart_idx, GenPart_pt, GenPart_eta, GenPart_phi, GenPart_mass, GenPart_pdgId,
+                            GenPart_statusFlags);
+                genLeptons.push_back(lepton);
+            }
+            return genLeptons;
+        } catch(std::runtime_error& e) {
+            std::cerr << "Event id = " << event << std::endl;
+            throw;
+        }
+    }
+
+    Kind kind() const { return kind_; }
+    int charge() const { return charge_; }
+    int firstCopyIndex() const { return firstCopy_; }
+    int lastCopyIndex() const { return lastCopy_; }
+
+    const LorentzVectorXYZ& visibleP4() const { return visibleP4_; }
+    const LorentzVectorXYZ& radiatedP4() const { return radiatedP4_; }
+
+    size_t nChargedHadrons() const { return nChargedHadrons_; }
+    size_t nNeutralHadrons() const { return nNeutralHadrons_; }
+    size_t nFinalStateElectrons() const { return nFinalStateElectrons_; }
+    size_t nFinalStateMuons() const { return nFinalStateMuons_; }
+    size_t nFinalStateNeutrinos() const { return nFinalStateNeutrinos_; }
+
+private:
+    struct Buffers {
+        // daughters of particle n with index > n, excluding gluons and quarks: children[offsets[n]:offsets[n+1]]
+        std::vector<int> offsets, children, position;
+        std::vector<uint64_t> processed;
+        std::vector<std::pair<int, bool>> stack;
+
+        template<typename IntVector>
+        void Reset(const IntVector& GenPart_genPartIdxMother, const IntVector& GenPart_pdgId)
+        {
+            const size_t n_parts = GenPart_pdgId.size();
+            processed.assign(n_parts / 64 + 1, 0);
+            offsets.assign(n_parts + 1, 0);
+            const auto isChild = [&](size_t idx) {
+                const int mother_idx = GenPart_genPartIdxMother[idx];
+                return mother_idx >= 0 && static_cast<size_t>(mother_idx) < idx
+                    && !GenParticle::gluonQuarks().count(static_cast<GenParticle::PdgId>(std::abs(GenPart_pdgId[idx])));
+            };
+            for(size_t idx = 0; idx < n_parts; ++idx) {
+                if(isChild(idx))
+                    ++offsets[GenPart_genPartIdxMother[idx] + 1];
+            }
+            for(size_t idx = 0; idx < n_parts; ++idx)
+                offsets[idx + 1] += offsets[idx];
+            children.resize(offsets[n_parts]);
+            position.assign(offsets.begin(), offsets.end() - 1);
+            for(size_t idx = 0; idx < n_parts; ++idx) {
+                if(isChild(idx))
+                    children[position[GenPart_genPartIdxMother[idx]]++] = idx;
+            }
+        }
+
+        bool IsProcessed(size_t idx) const { return (processed[idx / 64] >> (idx % 64)) & 1; }
+        void SetProcessed(size_t idx) { processed[idx / 64] |= uint64_t(1) << (idx % 64); }
+        const int* ChildrenBegin(int idx) const { return children.data() + offsets[idx]; }
+        const int* ChildrenEnd(int idx) const { return children.data() + offsets[idx + 1]; }
+        bool IsFinalState(int idx) const { return offsets[idx] == offsets[idx + 1]; }
+    };
+
+    static Buffers& GetBuffers()
+    {
+        static thread_local Buffers buffers;
+        return buffers;
+    }
+
+    template<typename IntVector, typename FloatVector>
+    void Fill(Buffers& buffers, int firstCopy, const FloatVector& GenPart_pt, const FloatVector& GenPart_eta,
+              const FloatVector& GenPart_phi, const FloatVector& GenPart_mass, const IntVector& GenPart_pdgId,
+              const IntVector& GenPart_statusFlags)
+    {
+        firstCopy_ = firstCopy;
+        GenParticle first_particle;
+        first_particle.pdgId = GenPart_pdgId[firstCopy];
+        charge_ = first_particle.getCharge();
+
+        const auto isLastCopy = [&](int idx) { return GenStatusFlags(GenPart_statusFlags[idx]).isLastCopy(); };
+        lastCopy_ = firstCopy;
+        while(!isLastCopy(lastCopy_)) {
+            const int* copy = std::find_if(buffers.ChildrenBegin(lastCopy_), buffers.ChildrenEnd(lastCopy_),
+                                           [&](int d) { return GenPart_pdgId[d] == GenPart_pdgId[lastCopy_]; });
+            if(copy == buffers.ChildrenEnd(lastCopy_))
+                ThrowError("unable to find a terminal copy.");
+            lastCopy_ = *copy;
+        }
+
+        const auto isNeutrino = [](GenParticle::PdgId pdg) { return GenParticle::NeutralLeptons().count(pdg) > 0; };
+        auto& stack = buffers.stack;
+        stack.clear();
+        stack.emplace_back(firstCopy, false);
+        while(!stack.empty()) {
+            auto [idx, fromLastCopy] = stack.back();
+            stack.pop_back();
+            if(buffers.IsProcessed(idx))
+                ThrowError("particle already processed!");
+            buffers.SetProcessed(idx);
+            fromLastCopy = fromLastCopy || idx == lastCopy_;
+            for(const int* d = buffers.ChildrenEnd(idx); d != buffers.ChildrenBegin(idx); --d)
+                stack.emplace_back(*(d - 1), fromLastCopy);
+
+            const bool isFinalState = buffers.IsFinalState(idx);
+            if(isFinalState && !isLastCopy(idx))
+                ThrowError("last copy flag is not set for a final state particle.");
+            if(!isLastCopy(idx)) continue;
+
+            const auto pdg = static_cast<GenParticle::PdgId>(std::abs(GenPart_pdgId[idx]));
+            const bool isChargedHadron = GenParticle::ChargedHadrons().count(pdg);
+            const bool isNeutralHadron = GenParticle::NeutralHadrons().count(pdg);
+            if(isFinalState) {
+                const LorentzVectorM p4(GenPart_pt[idx], GenPart_eta[idx], GenPart_phi[idx],
+                                        GenParticle::GetMass(pdg, GenPart_mass[idx]));
+                if(fromLastCopy) {
+                    if(isNeutrino(pdg)) {
+                        ++nFinalStateNeutrinos_;
+                    } else {
+                        if(pdg == GenParticle::PdgId::electron)
+                            ++nFinalStateElectrons_;
+                        if(pdg == GenParticle::PdgId::muon)
+                            ++nFinalStateMuons_;
+                        visibleP4_ += p4;
+                    }
+                } else {
+                    radiatedP4_ += p4;
+                }
+            }
+            if(fromLastCopy && (isChargedHadron || isNeutralHadron)) {
+                const bool isIntermediate = std::any_of(buffers.ChildrenBegin(idx), buffers.ChildrenEnd(idx),
+                    [&](int d) {
+                        const auto d_pdg = static_cast<GenParticle::PdgId>(std::abs(GenPart_pdgId[d]));
+                        return !GenParticle::ChargedLeptons().count(d_pdg) && !isNeutrino(d_pdg)
+                            && d_pdg != GenParticle::PdgId::photon;
+                    });
+                if(!isIntermediate) {
+                    size_t& nHad = isChargedHadron ? nChargedHadrons_ : nNeutralHadrons_;
+                    ++nHad;
+                }
+            }
+        }
+        kind_ = determineKind(static_cast<GenParticle::PdgId>(std::abs(GenPart_pdgId[lastCopy_])));
+    }
+
+    Kind determineKind(GenParticle::PdgId pdg) const
+    {
+        if(pdg == GenParticle::PdgId::electron)
+            return Kind::PromptElectron;
+        if(pdg == GenParticle::PdgId::muon)
+            return Kind::PromptMuon;
+        if(pdg != GenParticle::PdgId::tau)
+            std::cerr << "pdg code = "<<static_cast<int>(pdg) << std::endl;
+        if(nChargedHadrons_ == 0 && nNeutralHadrons_ != 0)
+            ThrowError("invalid hadron counts");
+        if(nChargedHadrons_ != 0)
+            return Kind::TauDecayedToHadrons;
+        if(nFinalStateElectrons_ == 1 && nFinalStateNeutrinos_ == 2)
+            return Kind::TauDecayedToElectron;
+        if(nFinalStateMuons_ == 1 && nFinalStateNeutrinos_ == 2)
+            return Kind::TauDecayedToMuon;
+        ThrowError("unable to determine gen lepton kind.");
+    }
+
+    [[noreturn]] void ThrowError(const std::string& message) const
+    {
+        std::cerr << "GenLepton first copy index = " << firstCopy_ << std::endl;
+        throw std::runtime_error("GenLepton: " + message);
+    }
+
+private:
+    Kind kind_{Kind::Other};
+    int charge_{0};
+    int firstCopy_{-1}, lastCopy_{-1};
+    LorentzVectorXYZ visibleP4_, radiatedP4_;
+    size_t nChargedHadrons_{0}, nNeutralHadrons_{0}, nFinalStateElectrons_{0}, nFinalStateMuons_{0},
+           nFinalStateNeutrinos_{0};
+};
+
 } // namespace gen_truth
 } // namespace reco_tau
\ No newline at end of file
@@ -1,5 +1,7 @@
 #pragma once
 
+#include <unordered_map>
+
 #include "AnalysisTools.h"
 #include "exception.h"
 #include "TextIO.h"
@@ -7,18 +9,72 @@
 #include "GenLepton.h"
 
 
+enum class ParticleType : int {
+  quark = 1 << 0,
+  diquark = 1 << 1,
+  lepton = 1 << 2,
+  boson = 1 << 3,
+  meson = 1 << 4,
+  baryon = 1 << 5,
+  nucleus = 1 << 6,
+  hadron = meson | baryon,
+};
+
+inline bool HasType(ParticleType type, ParticleType mask)
+{
+  return (static_cast<int>(type) & static_cast<int>(mask)) != 0;
+}
+
+inline const std::map<ParticleType, std::string>& ParticleTypeNames()
+{
+  static const std::map<ParticleType, std::string> names = {
+    { ParticleType::quark, "quark" }, { ParticleType::diquark, "diquark" }, { ParticleType::lepton, "lepton" },
+    { ParticleType::boson, "boson" }, { ParticleType::meson, "meson" }, { ParticleType::baryon, "baryon" },
+    { ParticleType::nucleus, "nucleus" },
+  };
+  return names;
+}
+
+inline ParticleType ParseParticleType(const std::string& name)
+{
+  for(const auto& [type, type_name] : ParticleTypeNames()) {
+    if(type_name == name)
+      return type;
+  }
+  throw analysis::exception("Unknown particle type '%1%'.") % name;
+}
+
+inline std::ostream& operator<<(std::ostream& os, ParticleType type)
+{
+  const auto& names = ParticleTypeNames();
+  const auto iter = names.find(type);
+  if(iter != names.end())
+    return os << iter->second;
+  return os << static_cast<int>(type);
+}
+
 struct ParticleInfo {
   int pdgId;
   int charge;
   std::string name;
-  std::string type;
+  ParticleType type;
   float mass{-1.};
+  bool fixedMass{false}; // the mass stored in the DB is used instead of the one from the event
+
+  bool isHadron() const { return HasType(type, ParticleType::hadron); }
 };
 
+// Particles with |pdgId| < MaxDensePdgId are looked up in a dense table, the others (nuclei, BSM) in a hash map.
 class ParticleDB {
 public:
+  static constexpr int MaxDensePdgId = 10000;
+
   static void Initialize(const std::string_view inputFile) {
-    std::ifstream file (std::string(inputFile).c_str(), ios::in );
+    static const std::set<int> pdgId_fixedMass { 11, 12, 13, 14, 15, 16, 22, 111, 211, 311, 321, 421, 411 };
+    auto& db = storage();
+    db = Storage();
+    db.dense_index.assign(2 * MaxDensePdgId + 1, -1);
+    std::ifstream file (std::string(inputFile).c_str(), std::ios::in );
      std::string line;
      while (getline(file, line)){
        auto values= analysis::SplitValueList(line,true,",",true);
@@ -28,46 +84,88 @@ public:
        ParticleInfo currentInfo;
        currentInfo.pdgId = analysis::Parse<int>(values.at(0));
        currentInfo.name = values.at(1);
-       currentInfo.type= values.at(2);
+       currentInfo.type= ParseParticleType(values.at(2));
        currentInfo.charge= analysis::Parse<int>(values.at(3));
        if(values.size()>4){
          currentInfo.mass = analysis::Parse<float>(values.at(4));
        }
-       particles()[currentInfo.pdgId] = currentInfo;
+       currentInfo.fixedMass = pdgId_fixedMass.count(std::abs(currentInfo.pdgId)) > 0;
+       db.Add(currentInfo);
      }
   }
 
-  static const ParticleInfo& GetParticleInfo(int pdgId)
+  static const ParticleInfo* FindParticleInfo(int pdgId)
   {
-    if(particles().empty())
+    const auto& db = storage();
+    if(db.infos.empty())
       throw analysis::exception("ParticleDB is not initialized.");
-    auto iter = particles().find(pdgId);
-    if(iter == particles().end()){
-      throw analysis::exception("ParticleInfo not found for particle ID");}
-    return iter->second;
+    int index = -1;
+    if(std::abs(pdgId) <= MaxDensePdgId) {
+      index = db.dense_index[pdgId + MaxDensePdgId];
+    } else {
+      const auto iter = db.sparse_index.find(pdgId);
+      if(iter != db.sparse_index.end())
+        index = iter->second;
+    }
+    return index >= 0 ? &db.infos[index] : nullptr;
+  }
+
+  static const ParticleInfo& GetParticleInfo(int pdgId)
+  {
+    const ParticleInfo* info = FindParticleInfo(pdgId);
+    if(!info)
+      throw analysis::exception("ParticleInfo not found for particle ID = %1%.") % pdgId;
+    return *info;
   }
+
   static const ParticleInfo& GetParticleInfo(std::string_view particle_name)
   {
-    for(const auto& info : particles()) {
-      if(info.second.name == particle_name)
-        return info.second;
-    }
-    throw analysis::exception("Particle with name '%1%' not found.") % particle_name;
+    const auto& db = storage();
+    const auto iter = db.name_index.find(std::string(particle_name));
+    if(iter == db.name_index.end())
+      throw analysis::exception("Particle with name '%1%' not found.") % particle_name;
+    return db.infos[iter->second];
   }
 
   static float GetMass(int pdgId, float mass)
   {
-    static const std::set<int> pdgId_noMass { 11, 12, 13, 14, 15, 16, 22, 111, 211, 311, 321, 421, 411 };
-    if(pdgId_noMass.count(std::abs(pdgId)))
-      return GetParticleInfo(pdgId).mass;
-    return mass;
+    const ParticleInfo* info = FindParticleInfo(pdgId);
+    return info && info->fixedMass ? info->mass : mass;
   }
 
 private:
-  static std::map<int, ParticleInfo>& particles()
+  struct Storage {
+    std::vector<ParticleInfo> infos;
+    std::vector<int> dense_index;
+    std::unordered_map<int, int> sparse_index;
+    std::unordered_map<std::string, int> name_index;
+
+    void Add(const ParticleInfo& info)
+    {
+      int* index;
+      if(std::abs(info.pdgId) <= MaxDensePdgId)
+        index = &dense_index[info.pdgId + MaxDensePdgId];
+      else {
+        auto iter = sparse_index.emplace(info.pdgId, -1).first;
+        index = &iter->second;
+      }
+      if(*index >= 0) {
+        infos[*index] = info;
+      } else {
+        *index = infos.size();
+        infos.push_back(info);
+      }
+      // for names shared by several particles, the one with the smallest pdgId is returned
+      auto [name_iter, inserted] = name_index.emplace(info.name, *index);
+      if(!inserted && infos[name_iter->second].pdgId >= info.pdgId)
+        name_iter->second = *index;
+    }
+  };
+
+  static Storage& storage()
   {
-    static std::map<int, ParticleInfo> p;
-    return p;
+    static Storage db;
+    return db;
   }
 };
 
@@ -102,16 +200,128 @@ inline Leg PdGToLeg(int pdg)
     return iter->second;
 }
 
+// Daughters of the generator particles in the compressed sparse row format: the daughters of particle n are
+// indices[offsets[n]], ..., indices[offsets[n+1] - 1], ordered by their index in the GenPart collection.
+struct GenPartDaughters {
+  class Range {
+  public:
+    Range(const int* begin, const int* end) : begin_(begin), end_(end) {}
+    const int* begin() const { return begin_; }
+    const int* end() const { return end_; }
+    size_t size() const { return end_ - begin_; }
+    bool empty() const { return begin_ == end_; }
+    int operator[](size_t n) const { return begin_[n]; }
+  private:
+    const int* begin_;
+    const int* end_;
+  };
+
+  RVecI offsets;
+  RVecI indices;
+
+  size_t size() const { return offsets.empty() ? 0 : offsets.size() - 1; }
+  Range operator[](size_t n) const { return Range(indices.data() + offsets[n], indices.data() + offsets[n + 1]); }
+  Range at(size_t n) const
+  {
+    if(n >= size())
+      throw analysis::exception("GenPartDaughters: index %1% is out of range (size = %2%).") % n % size();
+    return (*this)[n];
+  }
+};
+
+GenPartDaughters GetDaughters(const RVecI& GenPart_genPartIdxMother)
+{
+  const size_t n_parts = GenPart_genPartIdxMother.size();
+  GenPartDaughters daughters;
+  daughters.offsets.assign(n_parts + 1, 0);
+  for(int mother_idx : GenPart_genPartIdxMother) {
+    if(mother_idx < 0) continue;
+    if(static_cast<size_t>(mother_idx) >= n_parts)
+      throw analysis::exception("GetDaughters: invalid mother index = %1%.") % mother_idx;
+    ++daughters.offsets[mother_idx + 1];
+  }
+  std::partial_sum(daughters.offsets.begin(), daughters.offsets.end(), daughters.offsets.begin());
+  daughters.indices.resize(daughters.offsets[n_parts]);
+  RVecI position(daughters.offsets.begin(), daughters.offsets.end() - 1);
+  for(size_t part_idx = 0; part_idx < n_parts; ++part_idx) {
+    const int mother_idx = GenPart_genPartIdxMother[part_idx];
+    if(mother_idx >= 0)
+      daughters.indices[position[mother_idx]++] = part_idx;
+  }
+  return daughters;
+}
+
 bool isRelated(int potential_mother, int particle_idx, const RVecI& GenPart_genPartIdxMother)
 {
-  if(potential_mother == particle_idx) return true;
-  const int mother_idx = GenPart_genPartIdxMother.at(particle_idx);
-  if(mother_idx < 0) return false;
-  return isRelated(potential_mother, mother_idx, GenPart_genPartIdxMother);
+  for(int idx = particle_idx; idx >= 0; idx = GenPart_genPartIdxMother.at(idx)) {
+    if(idx == potential_mother) return true;
+  }
+  return false;
+}
+
+// Per-event summary of the GenPart ancestry, computed with one depth-first traversal of the decay forest.
+// flags[n] tells whether one of the ancestors of the particle n (excluding n itself) is a b quark or a Higgs boson.
+// [tin[n], tout[n]] is the Euler tour interval of n: m is an ancestor of n (or n itself) iff the interval of m contains
+// the interval of n.
+struct GenPartAncestry {
+  enum Flag : UChar_t { FromB = 1, FromH = 2 };
+
+  RVecUC flags;
+  RVecI tin, tout;
+
+  bool hasAncestor(int particle_idx, Flag flag) const { return flags.at(particle_idx) & flag; }
+  bool isRelated(int potential_mother, int particle_idx) const
+  {
+    if(potential_mother == particle_idx) return true;
+    return tin.at(potential_mother) >= 0 && tin.at(particle_idx) >= 0
+        && tin[potential_mother] <= tin[particle_idx] && tout[particle_idx] <= tout[potential_mother];
+  }
+};
+
+GenPartAncestry GetGenPartAncestry(const RVecI& GenPart_pdgId, const RVecI& GenPart_genPartIdxMother,
+                                   const GenPartDaughters& GenPart_daughters)
+{
+  const size_t n_parts = GenPart_pdgId.size();
+  GenPartAncestry ancestry;
+  ancestry.flags.assign(n_parts, 0);
+  ancestry.tin.assign(n_parts, -1);
+  ancestry.tout.assign(n_parts, -1);
+
+  const auto ownFlags = [&](int idx) -> UChar_t {
+    const int pdg = std::abs(GenPart_pdgId[idx]);
+    return (pdg == 5 ? GenPartAncestry::FromB : 0) | (pdg == 25 ? GenPartAncestry::FromH : 0);
+  };
+
+  int time = 0;
+  std::vector<std::pair<int, size_t>> stack;
+  for(size_t root = 0; root < n_parts; ++root) {
+    if(GenPart_genPartIdxMother[root] >= 0) continue;
+    ancestry.tin[root] = time++;
+    stack.emplace_back(root, 0);
+    while(!stack.empty()) {
+      auto& [idx, next_daughter] = stack.back();
+      const auto daughters = GenPart_daughters[idx];
+      if(next_daughter < daughters.size()) {
+        const int daughter = daughters[next_daughter++];
+        ancestry.flags[daughter] = ancestry.flags[idx] | ownFlags(idx);
+        ancestry.tin[daughter] = time++;
+        stack.emplace_back(daughter, 0);
+      } else {
+        ancestry.tout[idx] = time++;
+        stack.pop_back();
+      }
+    }
+  }
+  return ancestry;
+}
+
+bool isRelated(int potential_mother, int particle_idx, const GenPartAncestry& GenPart_ancestry)
+{
+  return GenPart_ancestry.isRelated(potential_mother, particle_idx);
 }
 
 int GetLastCopy(int genPart, const RVecI& GenPart_pdgId, const RVecI& GenPart_statusFlags,
-                const RVecVecI& GenPart_daughters)
+                const GenPartDaughters& GenPart_daughters)
 {
   GenStatusFlags pFlags(GenPart_statusFlags.at(genPart));
   int genPart_copy = genPart;
@@ -131,36 +341,45 @@ int GetLastCopy(int genPart, const RVecI& GenPart_pdgId, const RVecI& GenPart_st
   throw analysis::exception("Last copy not found.");
 }
 
-LorentzVectorM GetVisibleP4(int genPart, const RVecI& GenPart_pdgId, const RVecVecI& GenPart_daughters,
-                            const RVecF& GenPart_pt, const RVecF& GenPart_eta, const RVecF& GenPart_phi,
-                            const RVecF& GenPart_mass) {
-    LorentzVectorXYZ sum(0.,0.,0.,0.);
-    std::function<void(int)> addParticle;
-    addParticle = [&](int p) {
-      if(GenPart_daughters.at(p).empty() && !PdG::isNeutrino(p)) {
-        sum += LorentzVectorM(GenPart_pt.at(p), GenPart_eta.at(p), GenPart_phi.at(p),
-                              ParticleDB::GetMass(p, GenPart_mass.at(p)));
+// Visible four-momentum of each GenPart: the sum of the momenta of all final state descendants (or of the particle
+// itself, if it is in the final state), excluding neutrinos. Computed bottom-up in one pass over the decay forest.
+RVecLV GetGenPartVisibleP4(const RVecI& GenPart_pdgId, const RVecI& GenPart_genPartIdxMother,
+                           const GenPartDaughters& GenPart_daughters, const RVecF& GenPart_pt,
+                           const RVecF& GenPart_eta, const RVecF& GenPart_phi, const RVecF& GenPart_mass)
+{
+  const size_t n_parts = GenPart_pdgId.size();
+  std::vector<LorentzVectorXYZ> visible_p4(n_parts, LorentzVectorXYZ(0., 0., 0., 0.));
+  std::vector<std::pair<int, size_t>> stack;
+  for(size_t root = 0; root < n_parts; ++root) {
+    if(GenPart_genPartIdxMother[root] >= 0) continue;
+    stack.emplace_back(root, 0);
+    while(!stack.empty()) {
+      auto& [idx, next_daughter] = stack.back();
+      const auto daughters = GenPart_daughters[idx];
+      if(next_daughter < daughters.size()) {
+        const int daughter = daughters[next_daughter++];
+        stack.emplace_back(daughter, 0);
+        continue;
       }
-      for(int daughter : GenPart_daughters.at(p))
-        addParticle(daughter);
-    };
-    addParticle(genPart);
-    return LorentzVectorM(sum);
-}
-
-
-
-
-
-ROOT::VecOps::RVec<RVecI> GetDaughters(const RVecI& GenPart_genPartIdxMother ){
-  ROOT::VecOps::RVec<RVecI> daughters(GenPart_genPartIdxMother.size());
-  for (int part_idx =0; part_idx<GenPart_genPartIdxMother.size(); part_idx++){
-    if(GenPart_genPartIdxMother[part_idx]>=0){
-      daughters.at(GenPart_genPartIdxMother[part_idx]).push_back(part_idx);
+      if(daughters.empty()) {
+        const int pdg = GenPart_pdgId[idx];
+        if(!PdG::isNeutrino(pdg))
+          visible_p4[idx] = LorentzVectorM(GenPart_pt[idx], GenPart_eta[idx], GenPart_phi[idx],
+                                           ParticleDB::GetMass(pdg, GenPart_mass[idx]));
+      } else {
+        for(int daughter : daughters)
+          visible_p4[idx] += visible_p4[daughter];
+      }
+      stack.pop_back();
     }
   }
-  return daughters;
+
+  RVecLV result(n_parts);
+  for(size_t idx = 0; idx < n_parts; ++idx)
+    result[idx] = LorentzVectorM(visible_p4[idx]);
+  return result;
 }
+
 RVecI GetMothers(const int &part_idx, const RVecI& GenPart_genPartIdxMother ){
   RVecI mothers;
   int new_idx = part_idx;
@@ -175,34 +394,25 @@ RVecI GetMothers(const int &part_idx, const RVecI& GenPart_genPartIdxMother ){
 
 }
 
-RVecI GetLastHadrons(const RVecI& GenPart_pdgId, const RVecI& GenPart_genPartIdxMother, const ROOT::VecOps::RVec<RVecI>& GenPart_daughters){
+RVecI GetLastHadrons(const RVecI& GenPart_pdgId, const GenPartAncestry& GenPart_ancestry,
+                     const GenPartDaughters& GenPart_daughters)
+{
+  const size_t n_parts = GenPart_pdgId.size();
+  RVecB isHadron(n_parts);
+  for(size_t part_idx = 0; part_idx < n_parts; ++part_idx) {
+    const ParticleInfo& info = ParticleDB::GetParticleInfo(GenPart_pdgId[part_idx]);
+    isHadron[part_idx] = info.isHadron();
+  }
 
   RVecI lastHadrons;
-  //if(evt!=905) return lastHadrons;
-
-  for(int part_idx =0; part_idx<GenPart_pdgId.size(); part_idx++){
-    RVecI mothers = GetMothers(part_idx, GenPart_genPartIdxMother);
-    RVecI daughters = GenPart_daughters.at(part_idx);
-    bool comesFrom_b = false;
-    bool comesFrom_H = false;
-    bool hasHadronsDaughters = false;
-
-    for (auto& mother : mothers){
-      if(abs(GenPart_pdgId[mother])==5) comesFrom_b=true;
-      if(abs(GenPart_pdgId[mother])==25) comesFrom_H=true;
-    }
-    for (auto& daughter:daughters){
-      ParticleInfo daughterInformation = ParticleDB::GetParticleInfo(GenPart_pdgId[daughter]);
-      if(daughterInformation.type == "baryon" || daughterInformation.type == "meson"){
-        hasHadronsDaughters = true;
-      }
-    }
-    if(comesFrom_b && comesFrom_H && !hasHadronsDaughters){
-      ParticleInfo lastHadronInformation = ParticleDB::GetParticleInfo(GenPart_pdgId[part_idx]);
-      if(lastHadronInformation.type == "baryon" || lastHadronInformation.type == "meson"){
-        lastHadrons.push_back(part_idx);
-      }
-    }
+  for(size_t part_idx = 0; part_idx < n_parts; ++part_idx) {
+    if(!(isHadron[part_idx] && GenPart_ancestry.hasAncestor(part_idx, GenPartAncestry::FromB)
+         && GenPart_ancestry.hasAncestor(part_idx, GenPartAncestry::FromH))) continue;
+    const auto daughters = GenPart_daughters[part_idx];
+    const bool hasHadronsDaughters = std::any_of(daughters.begin(), daughters.end(),
+                                                 [&](int daughter) { return isHadron[daughter]; });
+    if(!hasHadronsDaughters)
+      lastHadrons.push_back(part_idx);
   }
   return lastHadrons;
 }
@@ -213,7 +423,7 @@ void PrintDecayChainParticle(ULong64_t evt, int genPart_idx, const RVecI& GenPar
                              const RVecI& GenPart_genPartIdxMother, const RVecI& GenPart_statusFlags,
                              const RVecF& GenPart_pt, const RVecF& GenPart_eta, const RVecF& GenPart_phi,
                              const RVecF& GenPart_mass, const RVecI& GenPart_status, const std::string pre,
-                             const ROOT::VecOps::RVec<RVecI>& GenPart_daughters, std::ostream& os)
+                             const GenPartDaughters& GenPart_daughters, std::ostream& os)
 {
   const ParticleInfo& particle_information = ParticleDB::GetParticleInfo(GenPart_pdgId[genPart_idx]);
   const float particleMass = ParticleDB::GetMass(GenPart_pdgId[genPart_idx], GenPart_mass[genPart_idx]);
@@ -234,7 +444,7 @@ void PrintDecayChainParticle(ULong64_t evt, int genPart_idx, const RVecI& GenPar
      << " type = " << particle_information.type
      << '\n';
 
-  const RVecI& daughters = GenPart_daughters.at(genPart_idx);
+  const auto daughters = GenPart_daughters.at(genPart_idx);
   for(int d_idx = 0; d_idx < daughters.size(); ++d_idx) {
     const int n = daughters[d_idx];
     os << pre << "+-> ";
@@ -245,46 +455,138 @@ void PrintDecayChainParticle(ULong64_t evt, int genPart_idx, const RVecI& GenPar
   }
 }
 
-int PrintDecayChain(ULong64_t evt, const RVecI& GenPart_pdgId, const RVecI& GenPart_genPartIdxMother,
-                    const RVecI& GenPart_statusFlags, const RVecF& GenPart_pt, const RVecF& GenPart_eta,
-                    const RVecF& GenPart_phi, const RVecF& GenPart_mass, const RVecI& GenPart_status,
-                    const RVecVecI& GenPart_daughters, const std::string& outFile)
+void PrintDecayChain(ULong64_t evt, const RVecI& GenPart_pdgId, const RVecI& GenPart_genPartIdxMother,
+                     const RVecI& GenPart_statusFlags, const RVecF& GenPart_pt, const RVecF& GenPart_eta,
+                     const RVecF& GenPart_phi, const RVecF& GenPart_mass, const RVecI& GenPart_status,
+                     const GenPartDaughters& GenPart_daughters, std::ostream& os)
 {
-  std::ofstream out_file(outFile, std::ios_base::app);
-  out_file << "event=" << evt << '\n';
+  os << "event=" << evt << '\n';
   for(int genPart_idx = 0; genPart_idx < GenPart_pdgId.size(); ++genPart_idx) {
     if(GenPart_genPartIdxMother[genPart_idx] == -1)
       PrintDecayChainParticle(evt, genPart_idx, GenPart_pdgId, GenPart_genPartIdxMother, GenPart_statusFlags, GenPart_pt,
-                              GenPart_eta, GenPart_phi, GenPart_mass, GenPart_status, "", GenPart_daughters, out_file);
+                              GenPart_eta, GenPart_phi, GenPart_mass, GenPart_status, "", GenPart_daughters, os);
   }
-  return 0;
 }
 
-
-int MatchGenLepton(const LorentzVectorM& obj_p4, const std::vector<reco_tau::gen_truth::GenLepton>& genLeptons, float dR_thr)
+// One JSON object per event with the flat list of particles and their mother/daughter indices.
+void PrintDecayChainJson(ULong64_t evt, const RVecI& GenPart_pdgId, const RVecI& GenPart_genPartIdxMother,
+                         const RVecI& GenPart_statusFlags, const RVecF& GenPart_pt, const RVecF& GenPart_eta,
+                         const RVecF& GenPart_phi, const RVecF& GenPart_mass, const RVecI& GenPart_status,
+                         const GenPartDaughters& GenPart_daughters, std::ostream& os)
 {
-  int best_idx=-1;
-  float dR_min = dR_thr;
-  for (int genLep_idx = 0; genLep_idx<genLeptons.size();genLep_idx++ ){
-    auto dR_objGenLep = ROOT::Math::VectorUtil::DeltaR(obj_p4, genLeptons.at(genLep_idx).visibleP4());
-    if(dR_objGenLep<dR_min){
-      dR_objGenLep = dR_min ;
-      best_idx= genLep_idx;
+  os << "{\"event\": " << evt << ", \"particles\": [";
+  for(size_t genPart_idx = 0; genPart_idx < GenPart_pdgId.size(); ++genPart_idx) {
+    const ParticleInfo& particle_information = ParticleDB::GetParticleInfo(GenPart_pdgId[genPart_idx]);
+    if(genPart_idx != 0)
+      os << ", ";
+    os << "{\"index\": " << genPart_idx
+       << ", \"pdgId\": " << GenPart_pdgId[genPart_idx]
+       << ", \"name\": \"" << particle_information.name << '"'
+       << ", \"pt\": " << GenPart_pt[genPart_idx]
+       << ", \"eta\": " << GenPart_eta[genPart_idx]
+       << ", \"phi\": " << GenPart_phi[genPart_idx]
+       << ", \"mass\": " << ParticleDB::GetMass(GenPart_pdgId[genPart_idx], GenPart_mass[genPart_idx])
+       << ", \"status\": " << GenPart_status[genPart_idx]
+       << ", \"statusFlags\": " << GenPart_statusFlags[genPart_idx]
+       << ", \"charge\": " << particle_information.charge
+       << ", \"mother\": " << GenPart_genPartIdxMother[genPart_idx]
+       << ", \"daughters\": [";
+    const auto daughters = GenPart_daughters.at(genPart_idx);
+    for(size_t d_idx = 0; d_idx < daughters.size(); ++d_idx)
+      os << (d_idx == 0 ? "" : ", ") << daughters[d_idx];
+    os << "]}";
+  }
+  os << "]}\n";
+}
+
+// Formats the decay chains of the events into per-slot buffers. The buffers are written to the output file
+// at once, in the order of the input entries, after the event loop.
+struct DecayChainDumper {
+  enum class Format { Text, JsonLines };
+
+  static void Initialize(size_t n_slots, Format format)
+  {
+    auto& data = Data();
+    data.format = format;
+    data.buffers = std::vector<std::vector<std::pair<ULong64_t, std::string>>>(std::max<size_t>(n_slots, 1));
+  }
+
+  static bool Fill(unsigned int slot, ULong64_t entry, ULong64_t evt, const RVecI& GenPart_pdgId,
+                   const RVecI& GenPart_genPartIdxMother, const RVecI& GenPart_statusFlags, const RVecF& GenPart_pt,
+                   const RVecF& GenPart_eta, const RVecF& GenPart_phi, const RVecF& GenPart_mass,
+                   const RVecI& GenPart_status, const GenPartDaughters& GenPart_daughters)
+  {
+    auto& data = Data();
+    if(slot >= data.buffers.size())
+      throw analysis::exception("DecayChainDumper: slot %1% is out of range.") % slot;
+    std::ostringstream os;
+    if(data.format == Format::JsonLines)
+      PrintDecayChainJson(evt, GenPart_pdgId, GenPart_genPartIdxMother, GenPart_statusFlags, GenPart_pt, GenPart_eta,
+                          GenPart_phi, GenPart_mass, GenPart_status, GenPart_daughters, os);
+    else
+      PrintDecayChain(evt, GenPart_pdgId, GenPart_genPartIdxMother, GenPart_statusFlags, GenPart_pt, GenPart_eta,
+                      GenPart_phi, GenPart_mass, GenPart_status, GenPart_daughters, os);
+    data.buffers[slot].emplace_back(entry, os.str());
+    return true;
+  }
+
+  static size_t Write(const std::string& outFile)
+  {
+    auto& data = Data();
+    std::vector<const std::pair<ULong64_t, std::string>*> events;
+    for(const auto& buffer : data.buffers) {
+      for(const auto& event : buffer)
+        events.push_back(&event);
     }
+    std::sort(events.begin(), events.end(), [](const auto* a, const auto* b) { return a->first < b->first; });
+    std::ofstream out_file(outFile, std::ios_base::app);
+    if(!out_file.is_open())
+      throw analysis::exception("DecayChainDumper: unable to open '%1%'.") % outFile;
+    for(const auto* event : events)
+      out_file << event->second;
+    for(auto& buffer : data.buffers)
+      buffer.clear();
+    return events.size();
   }
-  return best_idx;
+
+private:
+  struct Storage {
+    Format format{Format::Text};
+    std::vector<std::vector<std::pair<ULong64_t, std::string>>> buffers;
+  };
+
+  static Storage& Data()
+  {
+    static Storage data;
+    return data;
+  }
+};
+
+
+template<typename GenLeptonCollection>
+LVCollection GetGenLeptonsVisibleP4(const GenLeptonCollection& genLeptons)
+{
+  LVCollection visible_p4;
+  visible_p4.reserve(genLeptons.size());
+  for(const auto& genLepton : genLeptons)
+    visible_p4.push_back(LorentzVectorM(genLepton.visibleP4()));
+  return visible_p4;
 }
 
-RVecI MatchGenLepton(const RVecLV& obj_p4, const std::vector<reco_tau::gen_truth::GenLepton>& genLeptons, float dR_thr)
+template<typename GenLeptonCollection>
+int MatchGenLepton(const LorentzVectorM& obj_p4, const GenLeptonCollection& genLeptons, float dR_thr)
 {
-  RVecI best_indices(obj_p4.size(), -1);
-  for(int obj_idx = 0; obj_idx<obj_p4.size();obj_idx++){
-    best_indices[obj_idx] = MatchGenLepton(obj_p4.at(obj_idx),genLeptons, dR_thr);
-  }
-  return best_indices;
+  return FindMatching(obj_p4, GetGenLeptonsVisibleP4(genLeptons), dR_thr);
+}
+
+template<typename GenLeptonCollection>
+RVecI MatchGenLepton(const RVecLV& obj_p4, const GenLeptonCollection& genLeptons, float dR_thr)
+{
+  return FindMatching(obj_p4, GetGenLeptonsVisibleP4(genLeptons), dR_thr);
 }
 
-RVecI GetGenLeptonMatch(const RVecI& obj_genMatchIdx, const std::vector<reco_tau::gen_truth::GenLepton>& genLeptons)
+template<typename GenLeptonCollection>
+RVecI GetGenLeptonMatch(const RVecI& obj_genMatchIdx, const GenLeptonCollection& genLeptons)
 {
   using Kind = reco_tau::gen_truth::GenLepton::Kind;
   RVecI kind(obj_genMatchIdx.size(), static_cast<int>(GenLeptonMatch::NoMatch));
@@ -36,7 +36,7 @@ inline int ChannelToHHbTagInput (Channel channel)
 }
 
 struct HHBtagWrapper{
-    static void Initialize(const std::string& path, int version)
+    static void Initialize(const std::string& path, int version, size_t n_slots = 1)
     {
         std::array <std::string, 2> models;
         for(size_t n = 0; n < 2; ++n) {
@@ -44,25 +44,28 @@ struct HHBtagWrapper{
             ss_model << path + "HHbtag_v" << version << "_par_" << n;
             models.at(n) = ss_model.str();
         }
-        _Get() = std::make_unique<hh_btag::HH_BTag>(models);
+        auto& hh_btags = _Get();
+        hh_btags.clear();
+        for(size_t slot = 0; slot < std::max<size_t>(n_slots, 1); ++slot)
+            hh_btags.push_back(std::make_unique<hh_btag::HH_BTag>(models));
     }
-    static hh_btag::HH_BTag& Get()
+    static hh_btag::HH_BTag& Get(size_t slot = 0)
     {
-        auto& hh_btag = HHBtagWrapper::_Get();
-        if(!hh_btag)
-            throw std::runtime_error("HHBtag is not initialized.");
-        return *hh_btag;
+        auto& hh_btags = HHBtagWrapper::_Get();
+        if(slot >= hh_btags.size() || !hh_btags.at(slot))
+            throw analysis::exception("HHBtag is not initialized for slot %1%.") % slot;
+        return *hh_btags.at(slot);
     }
     private:
-    static std::unique_ptr<hh_btag::HH_BTag>& _Get()
+    static std::vector<std::unique_ptr<hh_btag::HH_BTag>>& _Get()
     {
-        static std::unique_ptr<hh_btag::HH_BTag> hh_btag;
-        return hh_btag;
+        static std::vector<std::unique_ptr<hh_btag::HH_BTag>> hh_btags;
+        return hh_btags;
     }
 };
 
 
-RVecF GetHHBtagScore(const RVecB& Jet_sel, const RVecI& Jet_idx, const RVecLV& jet_p4,const RVecF& Jet_deepFlavour, const float& met_pt, const float& met_phi,
+RVecF GetHHBtagScore(unsigned int slot, const RVecB& Jet_sel, const RVecI& Jet_idx, const RVecLV& jet_p4,const RVecF& Jet_deepFlavour, const float& met_pt, const float& met_phi,
                             const HTTCand& HTT_Cand, const int& period, int event){
     const ULong64_t parity = event % 2;
     int channelId = ChannelToHHbTagInput(HTT_Cand.channel());
@@ -98,7 +101,7 @@ RVecF GetHHBtagScore(const RVecB& Jet_sel, const RVecI& Jet_idx, const RVecLV& j
     }
 
 
-    RVecF goodJet_scores = HHBtagWrapper::Get().GetScore(jet_pt, jet_eta,
+    RVecF goodJet_scores = HHBtagWrapper::Get(slot).GetScore(jet_pt, jet_eta,
                                              rel_jet_M_pt, rel_jet_E_pt,
                                              jet_htt_deta, jet_deepFlavour,
                                              jet_htt_dphi, period,
@@ -0,0 +1,99 @@
+/*! Kernels for the dR matching between two collections of objects.
+    The pairwise dR^2 is computed on contiguous eta/phi arrays. Pairs with |deta| above the matching cone are
+    rejected before the phi difference is evaluated. */
+
+#pragma once
+
+#include <cmath>
+#include <limits>
+#include <vector>
+
+#include <ROOT/RVec.hxx>
+
+namespace matching {
+
+// Non-owning view on the eta/phi arrays of a collection.
+struct EtaPhiView {
+  const float* eta{nullptr};
+  const float* phi{nullptr};
+  size_t size{0};
+};
+
+// Row-major matrix of dR^2 between the objects of the first (rows) and the second (columns) collection.
+// Rejected pairs and pairs where one of the objects is not selected are set to +inf.
+struct DeltaR2Matrix {
+  static constexpr float Rejected = std::numeric_limits<float>::infinity();
+
+  size_t n_rows{0}, n_cols{0};
+  std::vector<float> values;
+
+  float operator()(size_t row, size_t col) const { return values[row * n_cols + col]; }
+  const float* Row(size_t row) const { return values.data() + row * n_cols; }
+
+  // Index of the column with the smallest dR^2 below dR2_thr, or -1.
+  int BestInRow(size_t row, float dR2_thr) const
+  {
+    int best_idx = -1;
+    float dR2_min = dR2_thr;
+    const float* row_values = Row(row);
+    for(size_t col = 0; col < n_cols; ++col) {
+      if(row_values[col] < dR2_min) {
+        dR2_min = row_values[col];
+        best_idx = static_cast<int>(col);
+      }
+    }
+    return best_idx;
+  }
+};
+
+inline float DeltaPhi(float phi1, float phi2)
+{
+  constexpr float pi = M_PI;
+  constexpr float two_pi = 2 * M_PI;
+  float dphi = phi2 - phi1;
+  dphi -= two_pi * (dphi > pi);
+  dphi += two_pi * (dphi < -pi);
+  return dphi;
+}
+
+// Fills dR^2 for all pairs of (a, b). Pairs with |deta| >= max_deltaR are marked as rejected.
+// The masks are optional; an object with a false entry in its mask is rejected against all others.
+inline void ComputeDeltaR2(const EtaPhiView& a, const EtaPhiView& b, float max_deltaR, DeltaR2Matrix& result,
+                           const ROOT::VecOps::RVec<bool>* a_sel = nullptr,
+                           const ROOT::VecOps::RVec<bool>* b_sel = nullptr)
+{
+  result.n_rows = a.size;
+  result.n_cols = b.size;
+  result.values.assign(a.size * b.size, DeltaR2Matrix::Rejected);
+  const float max_deltaR2 = max_deltaR * max_deltaR;
+  for(size_t i = 0; i < a.size; ++i) {
+    if(a_sel && !(*a_sel)[i]) continue;
+    const float eta_i = a.eta[i], phi_i = a.phi[i];
+    float* row = result.values.data() + i * b.size;
+    for(size_t j = 0; j < b.size; ++j) {
+      const float deta = b.eta[j] - eta_i;
+      if(std::abs(deta) >= max_deltaR) continue;
+      const float dphi = DeltaPhi(phi_i, b.phi[j]);
+      const float dR2 = deta * deta + dphi * dphi;
+      if(dR2 < max_deltaR2)
+        row[j] = dR2;
+    }
+    if(b_sel) {
+      for(size_t j = 0; j < b.size; ++j) {
+        if(!(*b_sel)[j])
+          row[j] = DeltaR2Matrix::Rejected;
+      }
+    }
+  }
+}
+
+inline DeltaR2Matrix ComputeDeltaR2(const EtaPhiView& a, const EtaPhiView& b, float max_deltaR,
+                                    const ROOT::VecOps::RVec<bool>* a_sel = nullptr,
+                                    const ROOT::VecOps::RVec<bool>* b_sel = nullptr)
+{
+  DeltaR2Matrix result;
+  ComputeDeltaR2(a, b, max_deltaR, result, a_sel, b_sel);
+  return result;
+}
+
+} // namespace matching
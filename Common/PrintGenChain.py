@@ -1,10 +1,14 @@
-def PrintDecayChain(df, evtIds, outFile):
+def PrintDecayChain(df, evtIds, outFile, jsonLines=False):
     if len(evtIds) > 0:
         df = df.Filter(f"static const std::set<ULong64_t> evts = {{ {evtIds} }}; return evts.count(event) > 0;")
-    df = df.Define('printer', f'''PrintDecayChain(event, GenPart_pdgId, GenPart_genPartIdxMother, GenPart_statusFlags,
-                                  GenPart_pt, GenPart_eta, GenPart_phi, GenPart_mass, GenPart_status, GenPart_daughters,
-                                  "{outFile}")''')
-    df.Histo1D("printer").GetValue()
+    import ROOT
+    chain_format = ROOT.DecayChainDumper.Format.JsonLines if jsonLines else ROOT.DecayChainDumper.Format.Text
+    ROOT.DecayChainDumper.Initialize(max(ROOT.GetThreadPoolSize(), 1), chain_format)
+    df = df.Filter('''DecayChainDumper::Fill(rdfslot_, rdfentry_, event, GenPart_pdgId, GenPart_genPartIdxMother,
+                                             GenPart_statusFlags, GenPart_pt, GenPart_eta, GenPart_phi, GenPart_mass,
+                                             GenPart_status, GenPart_daughters)''')
+    df.Count().GetValue()
+    return ROOT.DecayChainDumper.Write(outFile)
 
 if __name__ == "__main__":
     import argparse
@@ -14,12 +18,20 @@ if __name__ == "__main__":
     parser.add_argument('--inFile', type=str)
     parser.add_argument('--outFile', type=str)
     parser.add_argument('--evtIds', type=str, default='')
+    parser.add_argument('--eventIndex', type=str, default=None,
+                        help="event index of the input (see Common/EventIndex.py) used to read only the entries"
+                             " of --evtIds, which can also be given as run:lumi:event")
+    parser.add_argument('--format', type=str, default='text', choices=[ 'text', 'jsonl' ],
+                        help="ascii decay trees or JSON lines with the mother/daughter indices of all particles")
+    parser.add_argument('--nThreads', type=int, default=1)
     parser.add_argument('--particleFile', type=str,
                         default=f"{os.environ['ANALYSIS_PATH']}/config/pdg_name_type_charge.txt")
     args = parser.parse_args()
 
     import ROOT
     ROOT.gROOT.SetBatch(True)
+    if args.nThreads > 1:
+        ROOT.EnableImplicitMT(args.nThreads)
     ROOT.gROOT.ProcessLine(".include "+ os.environ['ANALYSIS_PATH'])
     ROOT.gROOT.ProcessLine('#include "Common/GenTools.h"')
     ROOT.gInterpreter.ProcessLine(f"ParticleDB::Initialize(\"{args.particleFile}\");")
@@ -30,6 +42,13 @@ if __name__ == "__main__":
     if not os.path.exists(outDir):
         os.makedirs(outDir)
 
-    df = ROOT.RDataFrame("Events", args.inFile)
+    evtIds = args.evtIds
+    if args.eventIndex is not None and len(evtIds) > 0:
+        import EventIndex
+        index = EventIndex.EventIndex.Load(args.eventIndex)
+        df, df_inputs = index.MakeDataFrame(EventIndex.ParseEventIds(evtIds), file=args.inFile)
+        evtIds = ''
+    else:
+        df = ROOT.RDataFrame("Events", args.inFile)
     df = df.Define("GenPart_daughters", "GetDaughters(GenPart_genPartIdxMother)")
-    PrintDecayChain(df, args.evtIds, args.outFile)
+    PrintDecayChain(df, evtIds, args.outFile, jsonLines=args.format == 'jsonl')
@@ -0,0 +1,201 @@
+/*! Per-stage timing of the event processing.
+    Each stage starts at a mark, i.e. an always-true filter that calls StageProfiler::Mark. The time (wall, CPU of the
+    thread) and the number of bytes read between two consecutive marks of the same slot are attributed to the stage of
+    the first mark. StageProfiler::EndEvent, called by an action booked after all the other ones, closes the last stage
+    of the event. The time until the mark that starts the next event, i.e. the reading of the next entry, is attributed
+    to the starting stage.
+    Lazily evaluated columns are accounted to the stage in which they are first used, unless they are passed to the
+    mark that closes their stage.
+    The number of bytes read is a process-wide counter, so it is measured only in the single-threaded mode. */
+
+#pragma once
+
+#include <chrono>
+#include <ctime>
+#include <iomanip>
+#include <iostream>
+#include <string>
+#include <vector>
+
+#include <TDirectory.h>
+#include <TFile.h>
+#include <TTree.h>
+
+#include "exception.h"
+
+struct StageProfiler {
+  struct Stats {
+    ULong64_t n_events{0};
+    double wall_time{0}, cpu_time{0};
+    Long64_t bytes_read{0};
+
+    Stats& operator+=(const Stats& other)
+    {
+      n_events += other.n_events;
+      wall_time += other.wall_time;
+      cpu_time += other.cpu_time;
+      bytes_read += other.bytes_read;
+      return *this;
+    }
+  };
+
+  struct Stage {
+    std::string group, name;
+    bool starts_event;
+  };
+
+  static void Initialize(size_t n_slots, bool count_bytes)
+  {
+    auto& data = Data();
+    data.stages.clear();
+    data.slots = std::vector<SlotState>(std::max<size_t>(n_slots, 1));
+    data.count_bytes = count_bytes;
+  }
+
+  static bool CountBytes() { return Data().count_bytes; }
+
+  static int AddStage(const std::string& group, const std::string& name, bool starts_event = false)
+  {
+    auto& data = Data();
+    if(data.slots.empty())
+      throw analysis::exception("StageProfiler is not initialized.");
+    data.stages.push_back({ group, name, starts_event });
+    for(auto& slot : data.slots)
+      slot.stats.resize(data.stages.size());
+    return static_cast<int>(data.stages.size()) - 1;
+  }
+
+  template<typename... Columns>
+  static bool Mark(unsigned int slot, ULong64_t /*entry*/, int stage, const Columns&...)
+  {
+    auto& data = Data();
+    Close(data, data.slots[slot], data.stages[stage].starts_event ? stage : -1);
+    auto& state = data.slots[slot];
+    ++state.stats[stage].n_events;
+    state.last_stage = stage;
+    return true;
+  }
+
+  static bool EndEvent(unsigned int slot)
+  {
+    auto& data = Data();
+    auto& state = data.slots[slot];
+    Close(data, state, -1);
+    state.last_stage = -1;
+    return true;
+  }
+
+  static Stats GetStats(int stage)
+  {
+    Stats total;
+    for(const auto& slot : Data().slots)
+      total += slot.stats.at(stage);
+    return total;
+  }
+
+  static void Write(TDirectory& dir, const std::string& group, const std::string& tree_name)
+  {
+    std::string stage_name;
+    Stats stats;
+    double events_per_second;
+    dir.cd();
+    TTree tree(tree_name.c_str(), tree_name.c_str());
+    tree.Branch("stage", &stage_name);
+    tree.Branch("n_events", &stats.n_events);
+    tree.Branch("wall_time", &stats.wall_time);
+    tree.Branch("cpu_time", &stats.cpu_time);
+    tree.Branch("events_per_second", &events_per_second);
+    tree.Branch("bytes_read", &stats.bytes_read);
+    const auto& stages = Data().stages;
+    for(size_t n = 0; n < stages.size(); ++n) {
+      if(stages[n].group != group) continue;
+      stage_name = stages[n].name;
+      stats = GetStats(n);
+      if(!Data().count_bytes)
+        stats.bytes_read = -1;
+      events_per_second = stats.wall_time > 0 ? stats.n_events / stats.wall_time : 0.;
+      tree.Fill();
+    }
+    tree.Write(tree_name.c_str(), TObject::kOverwrite);
+  }
+
+  static void Print(std::ostream& os)
+  {
+    const auto& stages = Data().stages;
+    double total_wall = 0;
+    for(size_t n = 0; n < stages.size(); ++n)
+      total_wall += GetStats(n).wall_time;
+    os << std::left << std::setw(40) << "stage" << std::right << std::setw(12) << "events"
+       << std::setw(12) << "wall, s" << std::setw(8) << "%" << std::setw(12) << "cpu, s"
+       << std::setw(14) << "events/s" << std::setw(14) << "MB read" << '\n';
+    for(size_t n = 0; n < stages.size(); ++n) {
+      const Stats stats = GetStats(n);
+      const std::string name = stages[n].group.empty() ? stages[n].name : stages[n].name + stages[n].group;
+      os << std::left << std::setw(40) << name << std::right << std::setw(12) << stats.n_events
+         << std::fixed << std::setprecision(2)
+         << std::setw(12) << stats.wall_time
+         << std::setw(8) << (total_wall > 0 ? stats.wall_time / total_wall * 100 : 0.)
+         << std::setw(12) << stats.cpu_time
+         << std::setw(14) << (stats.wall_time > 0 ? stats.n_events / stats.wall_time : 0.)
+         << std::setw(14);
+      if(Data().count_bytes)
+        os << stats.bytes_read / 1024. / 1024. << '\n';
+      else
+        os << "-" << '\n';
+      os.unsetf(std::ios_base::fixed);
+    }
+    os << std::flush;
+  }
+
+private:
+  struct SlotState {
+    std::vector<Stats> stats;
+    int last_stage{-1};
+    bool started{false};
+    double last_wall{0}, last_cpu{0};
+    Long64_t last_bytes{0};
+  };
+
+  struct Storage {
+    std::vector<Stage> stages;
+    std::vector<SlotState> slots;
+    bool count_bytes{true};
+  };
+
+  // Attributes the time since the previous mark of the slot to the open stage, or to stage if it is given.
+  static void Close(const Storage& data, SlotState& state, int stage)
+  {
+    const double wall = WallTime(), cpu = ThreadCpuTime();
+    const Long64_t bytes = data.count_bytes ? TFile::GetFileBytesRead() : 0;
+    const int target = stage >= 0 ? stage : state.last_stage;
+    if(state.started && target >= 0) {
+      auto& stats = state.stats[target];
+      stats.wall_time += wall - state.last_wall;
+      stats.cpu_time += cpu - state.last_cpu;
+      stats.bytes_read += bytes - state.last_bytes;
+    }
+    state.started = true;
+    state.last_wall = wall;
+    state.last_cpu = cpu;
+    state.last_bytes = bytes;
+  }
+
+  static Storage& Data()
+  {
+    static Storage data;
+    return data;
+  }
+
+  static double WallTime()
+  {
+    using clock = std::chrono::steady_clock;
+    return std::chrono::duration<double>(clock::now().time_since_epoch()).count();
+  }
+
+  static double ThreadCpuTime()
+  {
+    timespec ts;
+    clock_gettime(CLOCK_THREAD_CPUTIME_ID, &ts);
+    return ts.tv_sec + ts.tv_nsec * 1e-9;
+  }
+};
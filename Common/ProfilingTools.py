@@ -0,0 +1,50 @@
+import os
+import ROOT
+
+class StageProfiler:
+    """Wall/CPU time, event rate and bytes read per stage of the event processing.
+    The stages are delimited by always-true unnamed filters, so they do not show up in the cutflow reports.
+    The first mark of each event should be added with starts_event=True, and EndEvent should be booked after
+    all the other actions of the event loop. The bytes read are not measured in the multi-threaded mode,
+    where the ROOT counter is shared by all slots.
+    The profiler is a no-op when disabled."""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.groups = []
+        if not enabled: return
+        header_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ProfilingTools.h")
+        ROOT.gInterpreter.Declare(f'#include "{header_path}"')
+        ROOT.StageProfiler.Initialize(max(ROOT.GetThreadPoolSize(), 1), not ROOT.IsImplicitMTEnabled())
+
+    def Mark(self, df, stage, group='', columns=[], starts_event=False):
+        """Starts a new stage. Columns listed in 'columns' are evaluated before the mark,
+        i.e. they are accounted to the previous stage."""
+        if not self.enabled:
+            return df
+        if group not in self.groups:
+            self.groups.append(group)
+        stage_id = ROOT.StageProfiler.AddStage(group, stage, starts_event)
+        args = ', '.join([ 'rdfslot_', 'rdfentry_', str(stage_id) ] + columns)
+        return df.Filter(f"StageProfiler::Mark({args})")
+
+    def EndEvent(self, df):
+        """Books the action that closes the last stage of each event. It should be booked after all the other
+        actions of the event loop, since the actions are run in the booking order. The returned result should be kept
+        until the event loop has run, otherwise the action is removed from the loop."""
+        if not self.enabled:
+            return None
+        return df.Filter("StageProfiler::EndEvent(rdfslot_)").Count()
+
+    def Write(self, outFile, treeName="Profile", printOut=False):
+        if not self.enabled: return
+        outputRootFile = ROOT.TFile(outFile, "UPDATE")
+        for group in self.groups:
+            ROOT.StageProfiler.Write(outputRootFile, group, treeName + group)
+        outputRootFile.Close()
+        if printOut:
+            self.Print()
+
+    def Print(self):
+        if not self.enabled: return
+        ROOT.StageProfiler.Print(ROOT.std.cout)
@@ -1,4 +1,19 @@
 import ROOT
+def CutsToHist(cuts, reoprtName="Report"):
+    hist = ROOT.TH1D(reoprtName,reoprtName, len(cuts), 0, len(cuts))
+    for c_id, (cut_name, n_pass) in enumerate(cuts.items()):
+        hist.SetBinContent(c_id+1, n_pass)
+        hist.GetXaxis().SetBinLabel(c_id+1, cut_name)
+    return hist
+
+def ReportToCuts(report):
+    cuts = {}
+    for c_id, cut in enumerate(report):
+        if c_id == 0:
+            cuts["Initial"] = cut.GetAll()
+        cuts[cut.GetName()] = cut.GetPass()
+    return cuts
+
 def SaveReport(report, reoprtName="Report",printOut=False):
     cuts = [c for c in report]
     hist = ROOT.TH1D(reoprtName,reoprtName, len(cuts)+1, 0, len(cuts)+1)
@@ -11,4 +26,49 @@ def SaveReport(report, reoprtName="Report",printOut=False):
             print(f"for the cut {cut.GetName()} there are {cut.GetPass()} events passed over {cut.GetAll()}, resulting in an efficiency of {cut.GetEff()}")
     return hist
 
+class DeferredReport:
+    """Cutflow reports that are booked together with the other results of a dataframe and read only after the event
+    loop has run. Reports booked or added under the same name are merged cut by cut."""
+
+    def __init__(self):
+        self.booked = {}
+        self.added = {}
+
+    def Book(self, df, reportName="Report"):
+        self.booked.setdefault(reportName, []).append(df.Report())
+
+    def AddFromFile(self, fileName, reportName="Report"):
+        inputFile = ROOT.TFile.Open(fileName, "READ")
+        hist = inputFile.Get(reportName)
+        if hist:
+            cuts = { hist.GetXaxis().GetBinLabel(n): hist.GetBinContent(n) for n in range(1, hist.GetNbinsX() + 1) }
+            self.added.setdefault(reportName, []).append(cuts)
+        inputFile.Close()
+
+    def GetCuts(self, reportName="Report"):
+        merged = {}
+        all_cuts = [ ReportToCuts(report.GetValue()) for report in self.booked.get(reportName, []) ]
+        all_cuts.extend(self.added.get(reportName, []))
+        for cuts in all_cuts:
+            for cut_name, n_pass in cuts.items():
+                merged[cut_name] = merged.get(cut_name, 0) + n_pass
+        return merged
+
+    def Names(self):
+        return list(dict.fromkeys(list(self.booked.keys()) + list(self.added.keys())))
+
+    def Write(self, outFile, printOut=False):
+        outputRootFile = ROOT.TFile(outFile, "UPDATE")
+        for reportName in self.Names():
+            cuts = self.GetCuts(reportName)
+            if printOut:
+                PrintCuts(cuts, reportName)
+            outputRootFile.WriteTObject(CutsToHist(cuts, reportName), reportName, "Overwrite")
+        outputRootFile.Close()
 
+def PrintCuts(cuts, reportName="Report"):
+    n_initial = cuts.get("Initial", 0)
+    print(f"{reportName}:")
+    for cut_name, n_pass in cuts.items():
+        eff = n_pass / n_initial * 100 if n_initial > 0 else 0.
+        print(f"  {cut_name:<40} {int(n_pass):>12} {eff:8.2f}%")
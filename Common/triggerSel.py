@@ -1,14 +1,19 @@
+import re
 import yaml
 class Triggers():
     dict_legtypes = {"Electron":"Leg::e", "Muon":"Leg::mu", "Tau":"Leg::tau"}
 
-    def __init__(self, triggerFile, deltaR_matching=0.4):
+    def __init__(self, triggerFile, deltaR_matching=0.4, expression_cache=None):
         with open(triggerFile, "r") as stream:
             self.trigger_dict= yaml.safe_load(stream)
         self.deltaR_matching = deltaR_matching
+        self.expression_cache = expression_cache
 
     def ApplyTriggers(self, df, isData = False):
+        if self.expression_cache is not None:
+            df = self.expression_cache.Wrap(df)
         hltBranches = []
+        cuts = TriggerCuts(df)
         for path, path_dict in self.trigger_dict.items():
             path_key = 'path'
             if 'path' not in path_dict:
@@ -18,7 +23,7 @@ class Triggers():
             for key in keys:
                 trigger_string = key.split(' ')
                 trigName = trigger_string[0]
-                if trigName not in df.GetColumnNames():
+                if trigName not in cuts.df.GetColumnNames():
                     print(f"{trigName} does not exist!!")
                     path_dict[path_key].remove(key)
             or_paths = " || ".join(f'({p})' for p in path_dict[path_key])
@@ -28,29 +33,49 @@ class Triggers():
             for leg_id, leg_tuple in enumerate(path_dict['legs']):
                 leg_dict_offline= leg_tuple["offline_obj"]
                 type_name_offline = leg_dict_offline["type"]
-                var_name_offline = f'{type_name_offline}_offlineCut_{leg_id+1}_{path}'
-                df = df.Define(var_name_offline, leg_dict_offline["cut"])
+                var_name_offline = cuts.Define(type_name_offline, 'offlineCut', leg_dict_offline["cut"])
                 if not leg_tuple["doMatching"]:
                     if not leg_dict_offline["type"].startswith('MET'):
                         var_name_offline = f'{leg_dict_offline["type"]}_idx[{var_name_offline}].size()>0'
                     additional_conditions.append(var_name_offline)
                 else:
-                    df = df.Define(f'{type_name_offline}_{var_name_offline}_sel', f'httCand.isLeg({type_name_offline}_idx, {self.dict_legtypes[type_name_offline]}) && ({var_name_offline})')
+                    var_name_offline_sel = cuts.Define(type_name_offline, 'offlineSel',
+                        f'httCand.isLeg({type_name_offline}_idx, {self.dict_legtypes[type_name_offline]}) && ({var_name_offline})')
                     leg_dict_online= leg_tuple["online_obj"]
-                    var_name_online =  f'{leg_dict_offline["type"]}_onlineCut_{leg_id+1}_{path}'
-                    df = df.Define(f'{var_name_online}',f'{leg_dict_online["cut"]}')
-                    matching_var = f'{leg_dict_offline["type"]}_Matching_{leg_id+1}_{path}'
-                    df = df.Define(matching_var, f"""FindMatchingSet( {type_name_offline}_{var_name_offline}_sel,{var_name_online},
-                                                                            {leg_dict_offline["type"]}_p4, TrigObj_p4,{self.deltaR_matching} )""")
+                    var_name_online = cuts.Define('TrigObj', 'onlineCut', leg_dict_online["cut"])
+                    matching_var = cuts.Define(type_name_offline, 'Matching',
+                        f"FindMatchingMask({var_name_offline_sel}, {var_name_online}, {type_name_offline}_p4, TrigObj_p4, {self.deltaR_matching})")
                     total_objects_matched.append(f'{{ {self.dict_legtypes[type_name_offline]}, {matching_var} }}')
 
             legVector = f'{{ { ", ".join(total_objects_matched)} }}'
-            df = df.Define(f'hasOOMatching_{path}', f'HasOOMatching({legVector} )')
-            fullPathSelection = f'{or_paths} &&  hasOOMatching_{path}'
+            hasOOMatching = cuts.Define('hasOOMatching', 'legs', f'HasOOMatching({legVector} )')
+            fullPathSelection = f'{or_paths} &&  {hasOOMatching}'
             fullPathSelection += ' && '.join(additional_conditions)
             hltBranch = f'HLT_{path}'
             hltBranches.append(hltBranch)
-            df = df.Define(hltBranch, fullPathSelection)
+            cuts.df = cuts.df.Define(hltBranch, fullPathSelection)
         total_or_string = ' || '.join(hltBranches)
-        df = df.Filter(total_or_string)
+        df = cuts.df.Filter(total_or_string)
+        if self.expression_cache is not None:
+            df = df.node
         return df,hltBranches
+
+class TriggerCuts:
+    """Defines each distinct cut expression once and returns the existing column for equivalent expressions."""
+    token_re = re.compile(r'[A-Za-z_]\w*|[0-9.]+(?:[eE][+-]?[0-9]+)?[fF]?|&&|\|\||==|!=|<=|>=|<<|>>|::|->|\S')
+
+    def __init__(self, df):
+        self.df = df
+        self.columns = {}
+
+    @staticmethod
+    def Canonical(cut):
+        return ' '.join(TriggerCuts.token_re.findall(cut))
+
+    def Define(self, prefix, kind, cut):
+        key = (prefix, kind, TriggerCuts.Canonical(cut))
+        if key not in self.columns:
+            name = f'{prefix}_{kind}_{len(self.columns)}'
+            self.df = self.df.Define(name, cut)
+            self.columns[key] = name
+        return self.columns[key]
@@ -0,0 +1,27 @@
+import re
+
+def name_match(name, pattern):
+    if pattern.startswith('^'):
+        return re.match(pattern, name) is not None
+    return name == pattern
+
+def select_columns(all_columns, column_filters):
+    """Applies "keep X"/"drop X" rules in order, following the convention of RunKit/skim_tree.py:
+    "drop X" removes and "keep X" restores the matching columns. Patterns starting with ^ are regular expressions,
+    otherwise the column name should match exactly. The selected columns are returned in the input order."""
+    selected = { c: True for c in all_columns }
+    for column_filter in column_filters:
+        action, _, pattern = column_filter.partition(' ')
+        pattern = pattern.strip()
+        if action not in [ 'keep', 'drop' ]:
+            raise RuntimeError(f'Unknown column filter "{column_filter}".')
+        if len(pattern) == 0:
+            raise RuntimeError(f'Column filter "{column_filter}" with an empty pattern.')
+        for column in all_columns:
+            if name_match(column, pattern):
+                selected[column] = action == 'keep'
+    return [ c for c in all_columns if selected[c] ]
+
+def exclude_columns_filters(exclude_columns):
+    """Column filters equivalent to the --exclude-columns option of skim_tree.py."""
+    return [ f'drop {c}' for c in exclude_columns ]
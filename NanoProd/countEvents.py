@@ -1,12 +1,15 @@
+import json
+import math
 import os
-import numpy as np
+import sys
+import time
 import yaml
 
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 ROOT.gROOT.SetBatch(True)
 
-import sys
+from Common.EventKeys import MakeKeys, SplitKeys, UniqueKeyCounter
 
 def locate_files(folder, dataset_name=None):
     outputfiles = []
@@ -26,66 +29,250 @@ def locate_files(folder, dataset_name=None):
                     outputfiles.append(os.path.join(root, file))
     return outputfiles
 
-def check_good_files(input_files):
-    output_files = []
-    bad_files = []
+def check_file_full(file):
+    df = ROOT.RDataFrame("Events", file)
+    histo = df.Histo1D("event")
+    histo.GetValue()
+    return True
+
+def check_file_fast(file, branches=("event", "run", "luminosityBlock")):
+    # header, keys, Events entry count and the last basket of a few branches
+    root_file = ROOT.TFile.Open(file, "READ")
+    try:
+        if not root_file or root_file.IsZombie() or root_file.TestBit(ROOT.TFile.kRecovered):
+            return False
+        if root_file.GetListOfKeys().GetSize() == 0:
+            return False
+        tree = root_file.Get("Events")
+        if not tree:
+            return False
+        n_entries = tree.GetEntries()
+        for branch_name in branches:
+            branch = tree.GetBranch(branch_name)
+            if not branch or branch.GetEntries() != n_entries:
+                return False
+            if n_entries > 0 and branch.GetEntry(n_entries - 1) <= 0:
+                return False
+        return True
+    finally:
+        if root_file:
+            root_file.Close()
+
+def check_file(file, mode):
+    try:
+        return check_file_fast(file) if mode == "fast" else check_file_full(file)
+    except:
+        return False
+
+def file_key(file):
+    stat = os.stat(file)
+    return [ stat.st_size, stat.st_mtime ]
+
+def check_files_status(input_files, mode="full", n_workers=1, cache=None):
+    """Returns the good and the bad files, and the check results that are not in the cache yet."""
+    if cache is None:
+        cache = {}
+    results = {}
+    to_check = []
     for file in input_files:
-        try:
-            df = ROOT.RDataFrame("Events", file)
-            histo = df.Histo1D("event")
-            histo = histo.GetValue()
-            output_files.append(file)
-        except:
-            bad_files.append(file)
-    if len(bad_files) > 0:
-        print("Corrupted files:")
-        for file in bad_files:
-            print("  - %s" % file)
-    return output_files
-
-def check_files(int_folder, final_folder, sample_file):
+        entry = cache.get(file, None)
+        # a result of the full check is valid for the fast one as well
+        if entry is not None and entry["key"] == file_key(file) and (entry["mode"] == "full" or mode == "fast"):
+            results[file] = entry["good"]
+        else:
+            to_check.append(file)
+    if n_workers > 1 and len(to_check) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(n_workers) as pool:
+            good = list(pool.map(check_file, to_check, [ mode ] * len(to_check), chunksize=8))
+    else:
+        good = [ check_file(file, mode) for file in to_check ]
+    new_entries = {}
+    for file, is_good in zip(to_check, good):
+        results[file] = is_good
+        new_entries[file] = { "key": file_key(file), "mode": mode, "good": is_good }
+    good_files = [ file for file in input_files if results[file] ]
+    bad_files = [ file for file in input_files if not results[file] ]
+    return good_files, bad_files, new_entries
+
+def load_json(file_name):
+    if file_name is None or not os.path.exists(file_name):
+        return {}
+    with open(file_name, "r") as f:
+        return json.load(f)
+
+def save_json(data, file_name):
+    with open(file_name + ".tmp", "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(file_name + ".tmp", file_name)
+
+def count_entries(file):
+    root_file = ROOT.TFile.Open(file, "READ")
+    tree = root_file.Get("Events")
+    n_entries = tree.GetEntries() if tree else 0
+    root_file.Close()
+    return n_entries
+
+def count_unique_events(input_files, max_keys_in_memory=100_000_000, tmp_dir=None):
+    """Returns the total and the unique number of events, the duplicated (run, lumi, event) keys and their
+    multiplicities. Files are read one by one and, for large datasets, the keys are hash-partitioned into
+    temporary buckets of at most max_keys_in_memory keys on average."""
+    n_entries = sum(count_entries(file) for file in input_files)
+    n_buckets = int(math.ceil(n_entries / max_keys_in_memory))
+    with UniqueKeyCounter(n_buckets, tmp_dir=tmp_dir) as counter:
+        for file in input_files:
+            columns = ROOT.RDataFrame("Events", file).AsNumpy(columns=['run', 'luminosityBlock', 'event'])
+            counter.Add(MakeKeys(columns['run'], columns['luminosityBlock'], columns['event']))
+            del columns
+        n_unique, duplicates, multiplicities = counter.Finalize()
+        return counter.n_total, n_unique, duplicates, multiplicities
+
+def dataset_fingerprint(int_files, final_files, mode):
+    return { "mode": mode, "files": sorted([ [ file ] + file_key(file) for file in int_files + final_files ]) }
+
+def fingerprint_matches(previous, fingerprint):
+    # results of the full check are valid for the fast one as well
+    return previous["files"] == fingerprint["files"] \
+           and (previous["mode"] == fingerprint["mode"] or previous["mode"] == "full")
+
+def validate_dataset(dataset_name, int_files, final_files, mode, n_workers, file_cache, max_keys_in_memory,
+                     tmp_dir):
+    start = time.time()
+    int_files, int_bad, int_entries = check_files_status(int_files, mode, n_workers, file_cache)
+    final_files, final_bad, final_entries = check_files_status(final_files, mode, n_workers, file_cache)
+    crab_count, crab_unique, _, _ = count_unique_events(int_files, max_keys_in_memory, tmp_dir)
+    final_count, final_unique, duplicates, multiplicities = count_unique_events(final_files, max_keys_in_memory,
+                                                                                tmp_dir)
+    run, lumi, event = SplitKeys(duplicates)
+    summary = {
+        "dataset": dataset_name,
+        "crab_unique": int(crab_unique),
+        "final_unique": int(final_unique),
+        "crab_count": int(crab_count),
+        "final_count": int(final_count),
+        "n_duplicates": int(final_count - final_unique),
+        "corrupted_files": int_bad + final_bad,
+        "time": time.time() - start,
+    }
+    duplicated_events = [ [ int(run[n]), int(lumi[n]), int(event[n]), int(multiplicities[n]) ]
+                          for n in range(len(duplicates)) ]
+    int_entries.update(final_entries)
+    return summary, duplicated_events, int_entries
+
+def print_summary_row(summary):
+    print("{:<50} | {:>11} | {:>12} | {:>10} | {:>11} | {:>11} | {:>22}".format(
+        summary["dataset"], summary["crab_unique"], summary["final_unique"], summary["crab_count"],
+        summary["final_count"], summary["crab_unique"] - summary["final_unique"], summary["n_duplicates"]),
+        flush=True)
+
+csv_columns = [ "dataset", "crab_unique", "final_unique", "crab_count", "final_count", "n_duplicates",
+                "n_corrupted_files", "time" ]
+
+def save_csv(summaries, file_name):
+    import csv
+    with open(file_name, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(csv_columns)
+        for summary in summaries:
+            row = dict(summary, n_corrupted_files=len(summary["corrupted_files"]))
+            writer.writerow([ row[c] for c in csv_columns ])
+
+def check_files(int_folder, final_folder, sample_file, mode="full", n_workers=1, cache_file=None,
+                max_keys_in_memory=100_000_000, tmp_dir=None, duplicates_output=None, n_datasets=1,
+                summary_json=None, summary_csv=None, incremental=False):
+    """Validates the datasets in final_folder, n_datasets at a time. Results are written to summary_json/summary_csv.
+    With incremental=True, datasets whose files did not change since the run that produced summary_json are not
+    checked again."""
+    from concurrent.futures import ProcessPoolExecutor, as_completed
     print("\n{:<50} | {:>11} | {:>12} | {:>10} | {:>11} | {:>11} | {:>22}".format(
             "dataset", "crab unique", "final unique", "crab count", "final count",
             "dif uniques", "dif final count-unique"))
     print("-" * (53 + 14 + 15 + 13 + 14 + 14 + 22))
     with open(sample_file) as f:
         samples = yaml.load(f, yaml.Loader)
+    file_cache = load_json(cache_file)
+    previous = load_json(summary_json) if incremental else {}
+    results = {}
 
-    dataset_names = os.listdir(final_folder)
+    dataset_names = sorted(os.listdir(final_folder))
+    to_validate = {}
     for dataset_name in dataset_names:
         miniaod_d = samples[dataset_name]['miniAOD'].split("/")[1]
         int_files = locate_files(os.path.join(int_folder, miniaod_d), dataset_name)
         final_files = locate_files(os.path.join(final_folder, dataset_name))
+        fingerprint = dataset_fingerprint(int_files, final_files, mode)
+        if dataset_name in previous and fingerprint_matches(previous[dataset_name]["fingerprint"], fingerprint):
+            results[dataset_name] = previous[dataset_name]
+            print_summary_row(results[dataset_name]["summary"])
+        else:
+            to_validate[dataset_name] = (int_files, final_files, fingerprint)
 
-        int_files = check_good_files(int_files)
-        final_files = check_good_files(final_files)
-
-        df1 = ROOT.RDataFrame("Events", tuple(int_files))
-        df2 = ROOT.RDataFrame("Events", tuple(final_files))
-
-        sum_count = df1.Count()
-        sum_count2 = df2.Count()
-
-        columns1 = df1.AsNumpy(columns=['event', 'run', 'luminosityBlock'])
-        columns1 = np.stack((columns1['event'], columns1['run'], columns1['luminosityBlock']), axis=-1)
-        columns2 = df2.AsNumpy(columns=['event', 'run', 'luminosityBlock'])
-        columns2 = np.stack((columns2['event'], columns2['run'], columns2['luminosityBlock']), axis=-1)
-        sum1 = len(np.unique(columns1, axis=0))
-        sum2 = len(np.unique(columns2, axis=0))
+    def save():
+        if summary_json is not None:
+            save_json(results, summary_json)
+        if summary_csv is not None:
+            save_csv([ results[d]["summary"] for d in dataset_names if d in results ], summary_csv)
+        if cache_file is not None:
+            save_json(file_cache, cache_file)
 
-        print("{:<50} | {:>11} | {:>12} | {:>10} | {:>11} | {:>11} | {:>22}".format(
-            dataset_name, sum1, sum2, sum_count.GetValue(), sum_count2.GetValue(),
-            sum1 - sum2, sum_count2.GetValue() - sum2))
+    n_datasets = max(min(n_datasets, len(to_validate)), 1)
+    files_workers = max(n_workers // n_datasets, 1)
+    n_done = len(results)
+    with ProcessPoolExecutor(n_datasets) as pool:
+        futures = {}
+        for dataset_name, (int_files, final_files, fingerprint) in to_validate.items():
+            dataset_cache = { f: file_cache[f] for f in int_files + final_files if f in file_cache }
+            future = pool.submit(validate_dataset, dataset_name, int_files, final_files, mode, files_workers,
+                                 dataset_cache, max_keys_in_memory, tmp_dir)
+            futures[future] = (dataset_name, fingerprint)
+        for future in as_completed(futures):
+            dataset_name, fingerprint = futures[future]
+            summary, duplicated_events, new_cache_entries = future.result()
+            results[dataset_name] = { "summary": summary, "duplicates": duplicated_events,
+                                      "fingerprint": fingerprint }
+            file_cache.update(new_cache_entries)
+            n_done += 1
+            print_summary_row(summary)
+            print(f"[{n_done}/{len(dataset_names)}] {dataset_name}: {len(summary['corrupted_files'])} corrupted files,"
+                  f" done in {summary['time']:.1f} s", file=sys.stderr, flush=True)
+            save()
+    save()
 
+    if duplicates_output is not None:
+        with open(duplicates_output, "w") as f:
+            f.write("dataset,run,luminosityBlock,event,multiplicity\n")
+            for dataset_name in dataset_names:
+                for run, lumi, event, multiplicity in results[dataset_name]["duplicates"]:
+                    f.write(f"{dataset_name},{run},{lumi},{event},{multiplicity}\n")
+    return results
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Compare the number of events in crab and final outputs.")
+    parser.add_argument("int_folder", type=str)
+    parser.add_argument("final_folder", type=str)
+    parser.add_argument("sample_file", type=str)
+    parser.add_argument("--check-mode", type=str, default="full", choices=[ "fast", "full" ],
+                        help="fast: check file header, Events entries and the last basket of a few branches;"
+                             " full: read the whole event branch")
+    parser.add_argument("--n-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--cache", type=str, default=None,
+                        help="json file with the results of the previous checks, keyed by path, size and mtime")
+    parser.add_argument("--max-keys-in-memory", type=int, default=100_000_000,
+                        help="maximal number of event keys (16 bytes each) deduplicated at once")
+    parser.add_argument("--tmp-dir", type=str, default=None, help="directory for the temporary key buckets")
+    parser.add_argument("--duplicates", type=str, default=None,
+                        help="csv file to store the duplicated events of the final outputs")
+    parser.add_argument("--n-datasets", type=int, default=4, help="number of datasets validated concurrently")
+    parser.add_argument("--summary-json", type=str, default=None,
+                        help="json file with the per-dataset summary, duplicates, and fingerprints of the check mode"
+                             " and of the file lists")
+    parser.add_argument("--summary-csv", type=str, default=None, help="csv file with the per-dataset summary")
+    parser.add_argument("--incremental", action="store_true",
+                        help="reuse the results from --summary-json for the datasets whose files did not change")
+    args = parser.parse_args()
 
-    if len(sys.argv) != 4:
-        print("Usage: python countEvents.py int_folder final_folder sample_file")
-        sys.exit(1)
-
-    int_folder = sys.argv[1]
-    final_folder = sys.argv[2]
-    sample_file = sys.argv[3]
-
-    check_files(int_folder, final_folder, sample_file)
+    check_files(args.int_folder, args.final_folder, args.sample_file, mode=args.check_mode,
+                n_workers=args.n_workers, cache_file=args.cache, max_keys_in_memory=args.max_keys_in_memory,
+                tmp_dir=args.tmp_dir, duplicates_output=args.duplicates, n_datasets=args.n_datasets,
+                summary_json=args.summary_json, summary_csv=args.summary_csv, incremental=args.incremental)
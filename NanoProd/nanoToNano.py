@@ -2,12 +2,12 @@ import json
 import law
 import luigi
 import os
-import shutil
 import yaml
 
 from RunKit.grid_helper_tasks import CreateVomsProxy
 from RunKit.sh_tools import sh_call, xrd_copy
 from run_tools.law_customizations import Task, HTCondorWorkflow
+from NanoProd.skimPipeline import SkimPipeline
 
 class BaseTask(Task):
     dataset_tier = luigi.Parameter(default='nanoAOD')
@@ -70,6 +70,18 @@ class CreateDatasetInfos(BaseTask, law.LocalWorkflow):
         self.output().dump(result, indent=2)
 
 class CreateNanoSkims(BaseTask, HTCondorWorkflow, law.LocalWorkflow):
+    n_downloads = luigi.IntParameter(default=2, significant=False,
+                                     description="number of concurrent input file transfers")
+    n_skims = luigi.IntParameter(default=1, significant=False, description="number of concurrent skim processes")
+    disk_budget = luigi.FloatParameter(default=20., significant=False,
+                                       description="maximal size in GB of the input files stored locally at once")
+    merge_batch = luigi.IntParameter(default=10, significant=False,
+                                     description="number of skimmed files merged together in each merge step")
+    stream_inputs = luigi.BoolParameter(default=False, significant=False,
+                                        description="skim the inputs directly from the remote storage, "
+                                                    "falling back to a local copy on failure")
+    redirector = luigi.Parameter(default='root://cms-xrd-global.cern.ch/', significant=False,
+                                 description="XRootD redirector used to stream the inputs")
 
     def workflow_requires(self):
         return {"proxy" : CreateVomsProxy.req(self), "dataset_info": CreateDatasetInfos.req(self, workflow='local') }
@@ -93,30 +105,34 @@ class CreateNanoSkims(BaseTask, HTCondorWorkflow, law.LocalWorkflow):
         with open(skim_config_path, 'r') as f:
             skim_config = yaml.safe_load(f)
         exclude_columns = ','.join(skim_config['common']['exclude_columns'])
-        output_files = []
         os.makedirs(self.local_central_path(), exist_ok=True)
-        for n, input_file_entry in enumerate(sample_config['files']):
-            input_file_remote = input_file_entry['name']
+
+        def copy_fn(input_file_entry, input_file_local):
             adler32 = input_file_entry.get('adler32', None)
             if adler32 is not None:
                 adler32 = int(adler32, 16)
-            input_file_local = self.local_central_path(f'{self.branch}_{n}_in.root')
-            output_file = self.local_central_path(f'{self.branch}_{n}_out.root')
-            xrd_copy(input_file_remote, input_file_local, expected_adler32sum=adler32, silent=False)
+            xrd_copy(input_file_entry['name'], input_file_local, expected_adler32sum=adler32, silent=False)
+
+        def skim_fn(input_file_local, output_file):
             sh_call(['skim_tree.py', '--input', input_file_local, '--output', output_file, '--input-tree', 'Events',
                      '--other-trees', 'LuminosityBlocks,Runs',
                      '--exclude-columns', exclude_columns, '--verbose', '1'], verbose=1)
-            os.remove(input_file_local)
-            output_files.append(output_file)
-        output_path = self.output().path
+
+        def merge_fn(output_file, input_files):
+            sh_call(['haddnano.py', output_file] + input_files, verbose=1)
+
+        def stream_fn(input_file_entry, output_file):
+            cmd = [ 'python3', os.path.join(self.ana_path(), 'NanoProd', 'streamSkim.py'),
+                    '--input', self.redirector + input_file_entry['name'], '--output', output_file,
+                    '--input-tree', 'Events', '--other-trees', 'LuminosityBlocks,Runs',
+                    '--exclude-columns', exclude_columns, '--verbose', '1' ]
+            if input_file_entry.get('adler32', None) is not None:
+                cmd.extend([ '--expected-adler32', input_file_entry['adler32'] ])
+            sh_call(cmd, verbose=1)
+
+        pipeline = SkimPipeline(copy_fn, skim_fn, merge_fn, self.local_central_path(),
+                                n_downloads=self.n_downloads, n_skims=self.n_skims,
+                                disk_budget=int(self.disk_budget * 1024 ** 3), merge_batch=self.merge_batch,
+                                stream_fn=stream_fn if self.stream_inputs else None, prefix=f'{self.branch}_', verbose=1)
         os.makedirs(self.output().dirname, exist_ok=True)
-        if len(output_files) > 1:
-            output_tmp = output_path + '.tmp.root'
-            sh_call(['haddnano.py', output_tmp] + output_files, verbose=1)
-            for f in output_files:
-                os.remove(f)
-        elif len(output_files) == 1:
-            output_tmp = output_files[0]
-        else:
-            raise RuntimeError("No output files found.")
-        shutil.move(output_tmp, output_path)
+        pipeline.run(sample_config['files'], self.output().path)
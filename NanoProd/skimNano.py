@@ -1,30 +1,123 @@
-
 import os
 if os.path.exists(os.path.join(os.path.dirname(__file__), "BaselineSelection.py")):
   import BaselineSelection as Baseline
+  import CompileTools
+  from columnFilters import select_columns
 else:
   import Common.BaselineSelection as Baseline
+  import Common.CompileTools as CompileTools
+  from NanoProd.columnFilters import select_columns
 
-def skim_RecoLeptons(df):
+def apply_selection(df, selection):
+  # the selections use the *_p4 and *_sel columns, which are defined here for the central nanoAOD values
+  def reco_selection(df):
+    df = Baseline.CreateRecoP4(df)
+    df = Baseline.SelectRecoP4(df)
+    return selection(df)
+  # the selection is booked as typed callables, which are loaded from the expression library when it is available
   Baseline.Initialize()
-  df = Baseline.RecoLeptonsSelection(df)
-  return df
+  cache = CompileTools.GetExpressionCache()
+  return reco_selection(cache.Wrap(df)).node
+
+def skim_RecoLeptons(df):
+  def selection(df):
+    return Baseline.RecoLeptonsSelection(df)
+  return apply_selection(df, selection)
 
 def skim_failed_RecoLeptons(df):
-  Baseline.Initialize()
-  df, b0_filter = Baseline.RecoLeptonsSelection(df, apply_filter=False)
-  df = df.Filter(f'!({b0_filter})')
-  return df
+  def selection(df):
+    df, b0_filter = Baseline.RecoLeptonsSelection(df, apply_filter=False)
+    return df.Filter(f'!({b0_filter})')
+  return apply_selection(df, selection)
 
 def skim_RecoLeptonsJetAcceptance(df):
-  Baseline.Initialize()
-  df = Baseline.RecoLeptonsSelection(df)
-  df = Baseline.RecoJetAcceptance(df)
-  return df
+  def selection(df):
+    df = Baseline.RecoLeptonsSelection(df)
+    return Baseline.RecoJetAcceptance(df)
+  return apply_selection(df, selection)
 
 def skim_failed_RecoLeptonsJetAcceptance(df):
-  Baseline.Initialize()
-  df, b0_filter = Baseline.RecoLeptonsSelection(df, apply_filter=False)
-  df, b1_filter = Baseline.RecoJetAcceptance(df, apply_filter=False)
-  df = df.Filter(f'!(({b0_filter}) && ({b1_filter}))')
-  return df
+  def selection(df):
+    df, b0_filter = Baseline.RecoLeptonsSelection(df, apply_filter=False)
+    df, b1_filter = Baseline.RecoJetAcceptance(df, apply_filter=False)
+    return df.Filter(f'!(({b0_filter}) && ({b1_filter}))')
+  return apply_selection(df, selection)
+
+# Pass/fail mode: the selection is defined once and both the selected and the failed events are written
+# in the same event loop. The select_* functions return the dataframe and the name of the boolean selection column.
+
+def select_RecoLeptons(df):
+  def selection(df):
+    df, b0_filter = Baseline.RecoLeptonsSelection(df, apply_filter=False)
+    return df.Define('skim_pass', b0_filter)
+  return apply_selection(df, selection), 'skim_pass'
+
+def select_RecoLeptonsJetAcceptance(df):
+  def selection(df):
+    df, b0_filter = Baseline.RecoLeptonsSelection(df, apply_filter=False)
+    df, b1_filter = Baseline.RecoJetAcceptance(df, apply_filter=False)
+    return df.Define('skim_pass', f'({b0_filter}) && ({b1_filter})')
+  return apply_selection(df, selection), 'skim_pass'
+
+def skim_pass_fail(input_file, output_file, output_failed_file, skim_config, selection='select_RecoLeptons',
+                   input_tree='Events', other_trees=[], failed_tree='EventsNotSelected'):
+  import ROOT
+  select = globals()[selection]
+
+  df = ROOT.RDataFrame(input_tree, input_file)
+  input_columns = [ str(c) for c in df.GetColumnNames() ]
+  df, pass_column = select(df)
+
+  # columns defined by the selection are not stored
+  columns = select_columns(input_columns, skim_config.get('column_filters', []))
+  columns_failed = select_columns(input_columns, skim_config.get('column_filters_for_failed', []))
+
+  snapshot_options = ROOT.RDF.RSnapshotOptions()
+  snapshot_options.fLazy = True
+  snapshot_options.fMode = 'RECREATE'
+  snapshot_options.fCompressionAlgorithm = ROOT.ROOT.kLZMA
+  snapshot_options.fCompressionLevel = 9
+  snapshots = [ df.Filter(pass_column).Snapshot(input_tree, output_file, columns, snapshot_options) ]
+  if output_failed_file is not None:
+    snapshots.append(df.Filter(f'!{pass_column}').Snapshot(failed_tree, output_failed_file, columns_failed,
+                                                          snapshot_options))
+  ROOT.RDF.RunGraphs(snapshots)
+
+  if len(other_trees) > 0:
+    input_root_file = ROOT.TFile.Open(input_file, 'READ')
+    for out_file in [ output_file, output_failed_file ]:
+      if out_file is None: continue
+      output_root_file = ROOT.TFile.Open(out_file, 'UPDATE')
+      for tree_name in other_trees:
+        tree = input_root_file.Get(tree_name)
+        if not tree: continue
+        output_root_file.cd()
+        tree.CloneTree(-1, 'fast').Write(tree_name, ROOT.TObject.kOverwrite)
+      output_root_file.Close()
+    input_root_file.Close()
+
+if __name__ == '__main__':
+  import argparse
+  import yaml
+  parser = argparse.ArgumentParser(description='Write selected and failed events in a single event loop.')
+  parser.add_argument('--input', required=True, type=str)
+  parser.add_argument('--output', required=True, type=str)
+  parser.add_argument('--output-failed', required=False, type=str, default=None)
+  parser.add_argument('--config', required=False, type=str,
+                      default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config', 'skim.yaml'))
+  parser.add_argument('--selection', required=False, type=str, default='select_RecoLeptons',
+                      choices=[ 'select_RecoLeptons', 'select_RecoLeptonsJetAcceptance' ])
+  parser.add_argument('--input-tree', required=False, type=str, default='Events')
+  parser.add_argument('--other-trees', required=False, type=str, default='LuminosityBlocks,Runs')
+  parser.add_argument('--failed-tree', required=False, type=str, default='EventsNotSelected')
+  parser.add_argument('--nThreads', required=False, type=int, default=1)
+  args = parser.parse_args()
+
+  import ROOT
+  if args.nThreads > 1:
+    ROOT.EnableImplicitMT(args.nThreads)
+  with open(args.config, 'r') as f:
+    skim_config = yaml.safe_load(f)
+  other_trees = [ t for t in args.other_trees.split(',') if len(t) > 0 ]
+  skim_pass_fail(args.input, args.output, args.output_failed, skim_config, selection=args.selection,
+                 input_tree=args.input_tree, other_trees=other_trees, failed_tree=args.failed_tree)
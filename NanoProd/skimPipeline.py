@@ -0,0 +1,177 @@
+import glob
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+class DiskBudget:
+    """Limits the total size of the files that are present on the local disk at the same time.
+    A file larger than the budget is still allowed when nothing else is reserved."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, n_bytes):
+        with self.cond:
+            while self.max_bytes is not None and self.used > 0 and self.used + n_bytes > self.max_bytes:
+                self.cond.wait()
+            self.used += n_bytes
+
+    def release(self, n_bytes):
+        with self.cond:
+            self.used -= n_bytes
+            self.cond.notify_all()
+
+    def disable(self):
+        with self.cond:
+            self.max_bytes = None
+            self.cond.notify_all()
+
+class SkimPipeline:
+    """Download -> skim -> merge pipeline for a list of input files.
+    Downloads of the next files run in a thread pool while the previous ones are skimmed, skims run concurrently
+    (each skim is a separate process started by skim_fn), and the skimmed files are merged in batches, in the input
+    order, as soon as they become available.
+
+    copy_fn(input_entry, local_path), skim_fn(input_path, output_path) and merge_fn(output_path, input_paths)
+    are injectable, so that the pipeline can be run on local files with e.g. shutil.copy as copy_fn.
+    If stream_fn(input_entry, output_path) is provided, each input is first skimmed directly from the remote storage,
+    and it is downloaded and skimmed locally only if the streaming fails."""
+
+    def __init__(self, copy_fn, skim_fn, merge_fn, work_dir, n_downloads=2, n_skims=1, disk_budget=None,
+                 merge_batch=10, stream_fn=None, prefix='', verbose=0):
+        self.copy_fn = copy_fn
+        self.skim_fn = skim_fn
+        self.merge_fn = merge_fn
+        self.stream_fn = stream_fn
+        self.work_dir = work_dir
+        self.n_downloads = n_downloads
+        self.n_skims = n_skims
+        self.budget = DiskBudget(disk_budget)
+        self.merge_batch = max(merge_batch, 2)
+        self.prefix = prefix
+        self.verbose = verbose
+
+    def _log(self, msg):
+        if self.verbose > 0:
+            print(msg, flush=True)
+
+    def _download(self, n, entry):
+        size = entry.get('size', 0)
+        self.budget.acquire(size)
+        local_path = os.path.join(self.work_dir, f'{self.prefix}{n}_in.root')
+        try:
+            self.copy_fn(entry, local_path)
+        except:
+            if os.path.exists(local_path):
+                os.remove(local_path)
+            self.budget.release(size)
+            raise
+        self._log(f'downloaded {entry["name"]}')
+        return local_path
+
+    def _skim(self, n, input_path, size):
+        output_path = os.path.join(self.work_dir, f'{self.prefix}{n}_out.root')
+        try:
+            self.skim_fn(input_path, output_path)
+        finally:
+            os.remove(input_path)
+            self.budget.release(size)
+        self._log(f'skimmed {input_path}')
+        return output_path
+
+    def _stream(self, n, entry):
+        output_path = os.path.join(self.work_dir, f'{self.prefix}{n}_out.root')
+        try:
+            self.stream_fn(entry, output_path)
+        except Exception as e:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            print(f'Unable to stream {entry["name"]}: {e}. Falling back to a local copy.', flush=True)
+            return None
+        self._log(f'skimmed {entry["name"]} without a local copy')
+        return output_path
+
+    def _merge(self, output_path, input_paths):
+        self.merge_fn(output_path, input_paths)
+        for path in input_paths:
+            os.remove(path)
+        self._log(f'merged {len(input_paths)} files into {output_path}')
+
+    def run(self, input_entries, output_path):
+        if len(input_entries) == 0:
+            raise RuntimeError("No input files.")
+        os.makedirs(self.work_dir, exist_ok=True)
+        skimmed = {}
+        next_to_merge = 0
+        merged = []
+
+        def merge_ready(force):
+            nonlocal next_to_merge
+            while True:
+                batch = []
+                while next_to_merge + len(batch) in skimmed and len(batch) < self.merge_batch:
+                    batch.append(skimmed.pop(next_to_merge + len(batch)))
+                if len(batch) == 0 or (len(batch) < self.merge_batch and not force):
+                    for n, path in enumerate(batch):
+                        skimmed[next_to_merge + n] = path
+                    return
+                next_to_merge += len(batch)
+                if len(batch) == 1:
+                    merged.append(batch[0])
+                else:
+                    merged_path = os.path.join(self.work_dir, f'{self.prefix}merged_{len(merged)}.root')
+                    self._merge(merged_path, batch)
+                    merged.append(merged_path)
+
+        try:
+            with ThreadPoolExecutor(self.n_downloads) as download_pool, \
+                 ThreadPoolExecutor(self.n_skims) as skim_pool:
+                pending = {}
+                for n, entry in enumerate(input_entries):
+                    if self.stream_fn is None:
+                        pending[download_pool.submit(self._download, n, entry)] = ('download', n)
+                    else:
+                        pending[skim_pool.submit(self._stream, n, entry)] = ('stream', n)
+                try:
+                    while len(pending) > 0:
+                        done, _ = wait(pending.keys(), return_when=FIRST_COMPLETED)
+                        for future in done:
+                            step, n = pending.pop(future)
+                            result = future.result()
+                            if step == 'download':
+                                size = input_entries[n].get('size', 0)
+                                pending[skim_pool.submit(self._skim, n, result, size)] = ('skim', n)
+                            elif step == 'stream' and result is None:
+                                pending[download_pool.submit(self._download, n, input_entries[n])] = ('download', n)
+                            else:
+                                skimmed[n] = result
+                        merge_ready(force=False)
+                except:
+                    for future in pending.keys():
+                        future.cancel()
+                    # downloads waiting for the disk space should not block the shutdown of the pools
+                    self.budget.disable()
+                    raise
+            merge_ready(force=True)
+
+            if len(merged) > 1:
+                output_tmp = os.path.join(self.work_dir, f'{self.prefix}merged.root')
+                self._merge(output_tmp, merged)
+            else:
+                output_tmp = merged[0]
+            shutil.move(output_tmp, output_path)
+        except:
+            # the pools are shut down at this point, so no task can create new files
+            self._cleanup(len(input_entries))
+            raise
+
+    def _cleanup(self, n_inputs):
+        paths = [ os.path.join(self.work_dir, f'{self.prefix}{n}_{kind}.root')
+                  for n in range(n_inputs) for kind in [ 'in', 'out' ] ]
+        paths += glob.glob(os.path.join(glob.escape(self.work_dir), f'{glob.escape(self.prefix)}merged*.root'))
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
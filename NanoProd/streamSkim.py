@@ -0,0 +1,103 @@
+import os
+import re
+import subprocess
+
+if __package__ == "NanoProd":
+    from NanoProd.columnFilters import select_columns, exclude_columns_filters
+else:
+    from columnFilters import select_columns, exclude_columns_filters
+
+def split_url(url):
+    match = re.match(r'^(root://[^/]+)/(/.*)$', url)
+    if match is None:
+        raise RuntimeError(f'"{url}" is not a valid XRootD url.')
+    return match.group(1), match.group(2)
+
+def remote_adler32(url):
+    server, path = split_url(url)
+    output = subprocess.check_output(['xrdfs', server, 'query', 'checksum', path], universal_newlines=True)
+    algo, value = output.split()[:2]
+    if algo != 'adler32':
+        raise RuntimeError(f'Unexpected checksum type "{algo}" for {url}.')
+    return int(value, 16)
+
+def select_branches(tree, exclude_columns):
+    all_branches = [ str(b.GetName()) for b in tree.GetListOfBranches() ]
+    return select_columns(all_branches, exclude_columns_filters(exclude_columns))
+
+def cache_size_for(tree, branches, min_size=1024 ** 2):
+    # baskets of the selected branches for one cluster, with a margin for clusters larger than average
+    n_entries = max(tree.GetEntries(), 1)
+    cluster_size = tree.GetAutoFlush() if tree.GetAutoFlush() > 0 else n_entries
+    zip_bytes = sum(tree.GetBranch(b).GetZipBytes('*') for b in branches)
+    return max(int(1.5 * zip_bytes * min(cluster_size, n_entries) / n_entries), min_size)
+
+def stream_skim(input_url, output_file, exclude_columns, input_tree='Events', other_trees=[], verbose=0):
+    """Skims a remote file without a local copy. Only the baskets of the branches that are not excluded are read,
+    prefetched by a TTreeCache sized for one cluster of these branches."""
+    import ROOT
+    input_root_file = ROOT.TFile.Open(input_url, 'READ')
+    if not input_root_file or input_root_file.IsZombie():
+        raise RuntimeError(f'Unable to open {input_url}.')
+    output_root_file = ROOT.TFile(output_file, 'RECREATE', '', input_root_file.GetCompressionSettings())
+    for tree_name in [ input_tree ] + other_trees:
+        tree = input_root_file.Get(tree_name)
+        if not tree:
+            if tree_name == input_tree:
+                raise RuntimeError(f'Tree {tree_name} not found in {input_url}.')
+            continue
+        branches = select_branches(tree, exclude_columns) if tree_name == input_tree \
+                   else [ str(b.GetName()) for b in tree.GetListOfBranches() ]
+        tree.SetBranchStatus('*', 0)
+        for branch in branches:
+            tree.SetBranchStatus(branch, 1)
+        # SetBranchStatus also enables the leaf count branches. The output must have the same branches as
+        # the skim_tree.py outputs, otherwise they can't be merged together.
+        enabled = [ str(b.GetName()) for b in tree.GetListOfBranches() if tree.GetBranchStatus(b.GetName()) ]
+        if enabled != branches:
+            extra = sorted(set(enabled) - set(branches))
+            raise RuntimeError(f'{tree_name}: excluded branches {extra} are needed by the selected ones.')
+        cache_size = cache_size_for(tree, branches)
+        tree.SetCacheSize(cache_size)
+        for branch in branches:
+            tree.AddBranchToCache(branch, True)
+        tree.StopCacheLearningPhase()
+        output_root_file.cd()
+        tree_copy = tree.CloneTree(-1, 'fast')
+        if tree_copy.GetEntries() != tree.GetEntries():
+            raise RuntimeError(f'{tree_name}: {tree_copy.GetEntries()} out of {tree.GetEntries()} entries copied.')
+        tree_copy.Write(tree_name, ROOT.TObject.kOverwrite)
+        if verbose > 0:
+            print(f'{tree_name}: {len(branches)} branches, cache size = {cache_size / 1024 ** 2:.1f} MB')
+    bytes_read, file_size = input_root_file.GetBytesRead(), input_root_file.GetSize()
+    output_root_file.Close()
+    input_root_file.Close()
+    if verbose > 0:
+        print(f'{input_url}: {bytes_read / 1024 ** 2:.1f} MB read out of {file_size / 1024 ** 2:.1f} MB')
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Skim a remote nanoAOD file without copying it locally.')
+    parser.add_argument('--input', required=True, type=str)
+    parser.add_argument('--output', required=True, type=str)
+    parser.add_argument('--input-tree', required=False, type=str, default='Events')
+    parser.add_argument('--other-trees', required=False, type=str, default='LuminosityBlocks,Runs')
+    parser.add_argument('--exclude-columns', required=False, type=str, default='')
+    parser.add_argument('--expected-adler32', required=False, type=str, default=None,
+                        help='checksum of the remote file, verified before the skim')
+    parser.add_argument('--verbose', required=False, type=int, default=0)
+    args = parser.parse_args()
+
+    if args.expected_adler32 is not None:
+        adler32 = remote_adler32(args.input)
+        if adler32 != int(args.expected_adler32, 16):
+            raise RuntimeError(f'adler32 mismatch for {args.input}: {adler32:08x} != {args.expected_adler32}.')
+    exclude_columns = [ c for c in args.exclude_columns.split(',') if len(c) > 0 ]
+    other_trees = [ t for t in args.other_trees.split(',') if len(t) > 0 ]
+    try:
+        stream_skim(args.input, args.output, exclude_columns, input_tree=args.input_tree, other_trees=other_trees,
+                    verbose=args.verbose)
+    except:
+        if os.path.exists(args.output):
+            os.remove(args.output)
+        raise
@@ -1,5 +1,6 @@
 import ROOT
 import numpy as np
+import os
 import Common.Utilities as Utilities
 import Common.ReportTools as ReportTools
 
@@ -26,6 +27,8 @@ def createSkim(inFile, outFile, period, sample, X_mass, mpv, snapshotOptions):
     df = Baseline.GenJetHttOverlapRemoval(df)
     df = Baseline.RequestOnlyResolvedGenJets(df)
 
+    df = Baseline.CreateRecoP4(df)
+    df = Baseline.SelectRecoP4(df)
     df = Baseline.RecoLeptonsSelection(df)
     df = Baseline.RecoJetAcceptance(df)
     df = Baseline.RecoHttCandidateSelection(df)
@@ -55,10 +58,8 @@ def createSkim(inFile, outFile, period, sample, X_mass, mpv, snapshotOptions):
     n_MoreThanTwoMatches = df.Filter("Jet_idx[Jet_genMatched].size()>2").Count()
     df = JetSavingCondition(df)
 
-    report = df.Report()
-    histReport=ReportTools.SaveReport(report.GetValue())
-    if(n_MoreThanTwoMatches.GetValue()!=0) :
-        raise RuntimeError('There are more than two jets matched! ')
+    report = ReportTools.DeferredReport()
+    report.Book(df)
 
     colToSave = ["event","luminosityBlock",
                 "httCand_leg0_pt", "httCand_leg0_eta", "httCand_leg0_phi", "httCand_leg0_mass", "httCand_leg1_pt", "httCand_leg1_eta", "httCand_leg1_phi","httCand_leg1_mass",
@@ -68,9 +69,11 @@ def createSkim(inFile, outFile, period, sample, X_mass, mpv, snapshotOptions):
 
     varToSave = Utilities.ListToVector(colToSave)
     df.Snapshot("Event", outFile, varToSave, snapshotOptions)
-    outputRootFile= ROOT.TFile(outFile, "UPDATE")
-    outputRootFile.WriteTObject(histReport, "Report", "Overwrite")
-    outputRootFile.Close()
+    # the count is filled by the snapshot event loop
+    if(n_MoreThanTwoMatches.GetValue()!=0) :
+        os.remove(outFile)
+        raise RuntimeError('There are more than two jets matched! ')
+    report.Write(outFile)
 
 
 
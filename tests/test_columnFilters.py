@@ -0,0 +1,44 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from NanoProd.columnFilters import select_columns, exclude_columns_filters
+
+columns = [ 'run', 'nJet', 'Jet_pt', 'Jet_qgl', 'Jet_qglx', 'nSV', 'SV_x', 'HLT_IsoMu24', 'HLT_Ele32_WPTight' ]
+
+def test_keep_and_drop_order():
+    filters = [ 'drop Jet_qgl', 'drop ^(n|)SV(_.*|)$', 'drop ^HLT_.*$', 'keep ^HLT_(|Iso)Mu[1-9][0-9]+.*$' ]
+    assert select_columns(columns, filters) == [ 'run', 'nJet', 'Jet_pt', 'Jet_qglx', 'HLT_IsoMu24' ]
+
+def test_exclude_columns():
+    # --exclude-columns of skim_tree.py and streamSkim.py: exact names, or regular expressions starting with ^
+    filters = exclude_columns_filters([ 'Jet_qgl', '^HLT_.*$' ])
+    assert select_columns(columns, filters) == [ 'run', 'nJet', 'Jet_pt', 'Jet_qglx', 'nSV', 'SV_x' ]
+
+nano_columns = [ 'run', 'event', 'genWeight', 'LHE_HT', 'Pileup_nPU', 'Pileup_nTrueInt', 'Pileup_sumEOOT', 'nJet',
+                 'Jet_pt', 'Jet_qgl', 'Jet_cleanmask', 'nSV', 'SV_x', 'Tau_leadTkPtOverTauPt', 'HLT_IsoMu24',
+                 'HLT_Ele32_WPTight_Gsf', 'HLT_Ele23_Ele12_CaloIdL_TrackIdL_IsoVL', 'HLT_DoubleMu4_Jpsi_NoVertexing',
+                 'L1_SingleMu22', 'Jet_idx', 'Jet_p4', 'Jet_p4_nano', 'Jet_pt_sel', 'Electron_B0', 'Jet_B1T' ]
+
+def load_skim_config():
+    import yaml
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config', 'skim.yaml'), 'r') as f:
+        return yaml.safe_load(f)
+
+def test_skim_config():
+    pytest.importorskip('yaml')
+    skim_config = load_skim_config()
+    assert select_columns(nano_columns, skim_config['column_filters']) == \
+        [ 'run', 'event', 'genWeight', 'LHE_HT', 'Pileup_nPU', 'Pileup_nTrueInt', 'Pileup_sumEOOT', 'nJet', 'Jet_pt',
+          'HLT_IsoMu24', 'HLT_Ele32_WPTight_Gsf' ]
+    assert select_columns(nano_columns, skim_config['column_filters_for_failed']) == \
+        [ 'genWeight', 'LHE_HT', 'Pileup_nPU', 'Pileup_nTrueInt' ]
+
+def test_same_as_skim_tree():
+    pytest.importorskip('yaml')
+    skim_tree = pytest.importorskip('RunKit.skim_tree')
+    skim_config = load_skim_config()
+    for key in [ 'column_filters', 'column_filters_for_failed' ]:
+        assert sorted(select_columns(nano_columns, skim_config[key])) == \
+               sorted(skim_tree.select_items(nano_columns, skim_config[key]))
@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+import pytest
+
+pytest.importorskip('ROOT')
+
+common_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common')
+
+job = '''
+import sys
+sys.path.insert(0, {common_dir!r})
+import ROOT
+import CompileTools
+cache = CompileTools.ExpressionCache([], cache_dir={cache_dir!r})
+df = cache.Wrap(ROOT.RDataFrame(10).Define('x', 'static_cast<int>(rdfentry_)'))
+df = df.Define('y', 'x * 2').Define('z', 'y>x ? y : -1').Filter('z>4', 'z cut')
+total = df.Sum('z').GetValue()
+cache.WritePending()
+print(cache.n_hits, cache.n_misses, int(total))
+'''
+
+build = '''
+import sys
+sys.path.insert(0, {common_dir!r})
+import CompileTools
+sys.exit(0 if CompileTools.BuildExpressionLibrary({cache_dir!r}) else 1)
+'''
+
+def run_job(cache_dir):
+    output = subprocess.check_output([ sys.executable, '-c', job.format(common_dir=common_dir, cache_dir=cache_dir) ],
+                                     universal_newlines=True)
+    return [ int(x) for x in output.strip().split('\n')[-1].split() ]
+
+def test_cached_define(tmp_path):
+    # the first job jits the expressions, the build step compiles them into the library loaded by the second job
+    assert run_job(str(tmp_path)) == [ 0, 3, 84 ]
+    assert os.listdir(os.path.join(str(tmp_path), 'pending')) != []
+    subprocess.check_call([ sys.executable, '-c', build.format(common_dir=common_dir, cache_dir=str(tmp_path)) ])
+    assert os.listdir(os.path.join(str(tmp_path), 'pending')) == []
+    assert run_job(str(tmp_path)) == [ 3, 0, 84 ]
@@ -0,0 +1,119 @@
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from NanoProd.skimPipeline import DiskBudget, SkimPipeline
+
+def make_inputs(tmp_path, n_files, size=10):
+    src_dir = tmp_path / 'src'
+    src_dir.mkdir()
+    entries = []
+    for n in range(n_files):
+        path = src_dir / f'f{n}.txt'
+        path.write_text(f'{n}\n')
+        entries.append({ 'name': str(path), 'size': size })
+    return entries
+
+def copy_fn(entry, local_path):
+    time.sleep(random.random() * 0.01)
+    shutil.copy(entry['name'], local_path)
+
+def skim_fn(input_path, output_path):
+    time.sleep(random.random() * 0.01)
+    shutil.copy(input_path, output_path)
+
+def merge_fn(output_path, input_paths):
+    with open(output_path, 'w') as output:
+        for path in input_paths:
+            with open(path, 'r') as f:
+                output.write(f.read())
+
+def read_output(path):
+    with open(path, 'r') as f:
+        return [ int(x) for x in f.read().split() ]
+
+def test_merge_in_input_order(tmp_path):
+    entries = make_inputs(tmp_path, 23)
+    work_dir = tmp_path / 'work'
+    pipeline = SkimPipeline(copy_fn, skim_fn, merge_fn, str(work_dir), n_downloads=3, n_skims=2, merge_batch=4)
+    pipeline.run(entries, str(tmp_path / 'out.txt'))
+    assert read_output(tmp_path / 'out.txt') == list(range(23))
+    assert os.listdir(work_dir) == []
+
+def test_disk_budget_blocks():
+    budget = DiskBudget(20)
+    budget.acquire(15)
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (budget.acquire(10), acquired.set()))
+    thread.start()
+    assert not acquired.wait(0.1)
+    budget.release(15)
+    assert acquired.wait(1)
+    thread.join()
+
+def test_disk_budget_limits_local_inputs(tmp_path):
+    entries = make_inputs(tmp_path, 12)
+    work_dir = tmp_path / 'work'
+    lock = threading.Lock()
+    max_inputs = 0
+
+    def counting_copy_fn(entry, local_path):
+        nonlocal max_inputs
+        copy_fn(entry, local_path)
+        with lock:
+            n_inputs = len([ f for f in os.listdir(work_dir) if f.endswith('_in.root') ])
+            max_inputs = max(max_inputs, n_inputs)
+
+    def slow_skim_fn(input_path, output_path):
+        time.sleep(0.02)
+        skim_fn(input_path, output_path)
+
+    pipeline = SkimPipeline(counting_copy_fn, slow_skim_fn, merge_fn, str(work_dir), n_downloads=4, n_skims=1,
+                            disk_budget=20)
+    pipeline.run(entries, str(tmp_path / 'out.txt'))
+    assert read_output(tmp_path / 'out.txt') == list(range(12))
+    assert max_inputs == 2
+
+def test_stream_fallback(tmp_path):
+    entries = make_inputs(tmp_path, 10)
+    work_dir = tmp_path / 'work'
+    copied = []
+
+    def stream_fn(entry, output_path):
+        if int(os.path.basename(entry['name'])[1:-4]) % 3 == 0:
+            with open(output_path, 'w') as f:
+                f.write('partial\n')
+            raise RuntimeError('stream error')
+        shutil.copy(entry['name'], output_path)
+
+    def recording_copy_fn(entry, local_path):
+        copied.append(entry['name'])
+        copy_fn(entry, local_path)
+
+    pipeline = SkimPipeline(recording_copy_fn, skim_fn, merge_fn, str(work_dir), n_downloads=2, n_skims=2,
+                            merge_batch=3, stream_fn=stream_fn)
+    pipeline.run(entries, str(tmp_path / 'out.txt'))
+    assert read_output(tmp_path / 'out.txt') == list(range(10))
+    assert sorted(copied) == sorted(entries[n]['name'] for n in [ 0, 3, 6, 9 ])
+    assert os.listdir(work_dir) == []
+
+def test_cleanup_on_failure(tmp_path):
+    entries = make_inputs(tmp_path, 15)
+    work_dir = tmp_path / 'work'
+
+    def failing_skim_fn(input_path, output_path):
+        skim_fn(input_path, output_path)
+        if input_path.endswith('_7_in.root'):
+            raise RuntimeError('skim error')
+
+    pipeline = SkimPipeline(copy_fn, failing_skim_fn, merge_fn, str(work_dir), n_downloads=3, n_skims=2,
+                            disk_budget=30, merge_batch=2, prefix='job_')
+    with pytest.raises(RuntimeError, match='skim error'):
+        pipeline.run(entries, str(tmp_path / 'out.txt'))
+    assert os.listdir(work_dir) == []
+    assert not os.path.exists(tmp_path / 'out.txt')